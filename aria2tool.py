@@ -4,15 +4,38 @@ import json
 import random
 import socket
 import string
+import sys
+import base64
+import struct
 import secrets
 import requests
+import threading
 import subprocess
+import time
 
-from typing import Dict, List, Literal, Optional, TypedDict
+from typing import Callable, Dict, List, Literal, Optional, Tuple, TypedDict
+from urllib.parse import urlsplit
 from pathlib import Path
 from pydantic import BaseModel
 from spdlogger import logger
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def JsonDumps(data) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data).encode()
+
+
+def JsonLoads(data: bytes):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
 
 def CheckHostPortIdle(port: int):
     if port == 0:
@@ -38,7 +61,7 @@ globle_server_id: List[int] = []
 
 
 class Aria2Server:
-    def __init__(self, dl_dir: str, dl_max: int, server_id: int = 0) -> None:
+    def __init__(self, dl_dir: str, dl_max: int, server_id: int = 0, session_file: Optional[Path] = None) -> None:
         self.logger = logger.ObjLogger(self)
         self._port: int = int(6800)
         self._token: str = str()
@@ -77,6 +100,20 @@ class Aria2Server:
             f"--rpc-secret={self._token}",
         ]
 
+        # 断点续传 保存未完成任务和缓存文件 启动时恢复
+        self.session_file = session_file
+        if self.session_file is not None:
+            self.session_file.parent.mkdir(parents=True, exist_ok=True)
+            self._args.remove("--continue=false")
+            self._args.remove("--file-allocation=prealloc")
+            self._args += [
+                "--continue=true",
+                # 预分配的文件大小不能表示已下载的长度
+                "--file-allocation=none",
+                f"--save-session={self.session_file.as_posix()}",
+                "--save-session-interval=10",
+            ]
+
         while True:
             if server_id in globle_server_id:
                 server_id += 1
@@ -112,6 +149,8 @@ class Aria2Server:
         cmd = str(self._exec)
         for i in self._args:
             cmd += " " + i
+        if self.session_file is not None and self.session_file.is_file():
+            cmd += " " + f"--input-file={self.session_file.as_posix()}"
         return cmd
 
     def Stop(self):
@@ -153,6 +192,13 @@ class Aria2Server:
         return False
 
 
+def _Construct(model, **values):
+    construct = getattr(model, "model_construct", None)
+    if construct is None:
+        construct = model.construct
+    return construct(**values)
+
+
 class RpcStructUris(BaseModel):
     status: Literal["used", "waiting"]
     uri: str
@@ -177,6 +223,26 @@ class RpcStructStatus(BaseModel):
     errorMessage: Optional[str] = None
     dir: str
 
+    @staticmethod
+    def Construct(result: dict) -> "RpcStructStatus":
+        # 跳过验证 仅转换数字字段
+        return _Construct(
+            RpcStructStatus,
+            gid=result["gid"],
+            status=result["status"],
+            totalLength=int(result["totalLength"]),
+            completedLength=int(result["completedLength"]),
+            downloadSpeed=int(result["downloadSpeed"]),
+            errorCode=result.get("errorCode"),
+            errorMessage=result.get("errorMessage"),
+            dir=result["dir"],
+        )
+
+
+class RpcStructFault(BaseModel):
+    faultCode: int
+    faultString: str
+
 
 class RpcStructVersion(BaseModel):
     enabledFeatures: List[str]
@@ -195,11 +261,22 @@ class RpcStructGlobalStat(BaseModel):
     numStopped: int
     numStoppedTotal: int
 
+    @staticmethod
+    def Construct(result: dict) -> "RpcStructGlobalStat":
+        keys = ["downloadSpeed", "uploadSpeed", "numActive", "numWaiting", "numStopped", "numStoppedTotal"]
+        return _Construct(RpcStructGlobalStat, **{key: int(result[key]) for key in keys})
+
 
 class Aria2Client:
-    def __init__(self, server: str, token: str) -> None:
+    STATUS_KEYS = ["gid", "status", "totalLength", "completedLength", "downloadSpeed", "dir", "errorCode", "errorMessage"]
+
+    def __init__(self, server: str, token: str, validate: bool = True) -> None:
         self.token: str = f"token:{token}"
         self.rpc = f"{server}/jsonrpc"
+        # validate=False 时 状态查询跳过 pydantic 验证
+        self.validate = validate
+        self.session = requests.Session()
+        self.session.headers.update({"Content-Type": "application/json"})
         self.default_ua = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/141.0.0.0 Safari/537.36 Edg/141.0.0.0"
 
     def _make_rpcjson(self, method: str, params) -> dict:
@@ -210,8 +287,27 @@ class Aria2Client:
             "params": params,
         }
 
+    def _make_methodcall(self, method: str, params: list) -> dict:
+        return {
+            "methodName": method,
+            "params": [self.token, *params],
+        }
+
+    def _MakeStatus(self, result: dict) -> RpcStructStatus:
+        if self.validate:
+            return RpcStructStatus(**result)
+        return RpcStructStatus.Construct(result)
+
+    def _MakeGlobalStat(self, result: dict) -> RpcStructGlobalStat:
+        if self.validate:
+            return RpcStructGlobalStat(**result)
+        return RpcStructGlobalStat.Construct(result)
+
+    def Close(self):
+        self.session.close()
+
     def _post(self, data: dict):
-        j: dict = requests.post(self.rpc, json.dumps(data).encode()).json()
+        j: dict = JsonLoads(self.session.post(self.rpc, JsonDumps(data)).content)
         error = j.get("error")
         if error is not None:
             raise SyntaxError(f"\n#### Error: \nsend = {data} \nrecv = {j} \n####\n")
@@ -220,15 +316,34 @@ class Aria2Client:
             raise SyntaxError(f"\n#### NotResult: \nsend = {data} \nrecv = {j} \n####\n")
         return result
 
-    def AddUri(
+    def Multicall(self, calls: List[Tuple[str, list]]) -> list:
+        # system.multicall 一次请求执行多个方法 失败的方法返回 RpcStructFault
+        if len(calls) == 0:
+            return []
+        data = self._make_rpcjson(
+            "system.multicall",
+            [[self._make_methodcall(method, params) for method, params in calls]],
+        )
+        results = self._post(data)
+        if not isinstance(results, list) or len(results) != len(calls):
+            raise SyntaxError(f"\n#### Multicall: \nsend = {data} \nrecv = {results} \n####\n")
+        ret: list = []
+        for result in results:
+            if isinstance(result, list) and len(result) == 1:
+                ret.append(result[0])
+                continue
+            ret.append(RpcStructFault(**result))
+            continue
+        return ret
+
+    def _MakeAddUriOptions(
         self,
-        url: str,
         savepath: str,
         filename: str,
         user_agent: str | None = None,
         proxy: str | None = None,
         ext_options: dict | None = None,
-    ) -> str:
+    ) -> dict:
         options = {
             "dir": savepath,
             "out": filename,
@@ -244,6 +359,19 @@ class Aria2Client:
         if ext_options is not None:
             options.update(ext_options)
 
+        return options
+
+    def AddUri(
+        self,
+        url: str,
+        savepath: str,
+        filename: str,
+        user_agent: str | None = None,
+        proxy: str | None = None,
+        ext_options: dict | None = None,
+    ) -> str:
+        options = self._MakeAddUriOptions(savepath, filename, user_agent, proxy, ext_options)
+
         data = self._make_rpcjson(
             "aria2.addUri",
             [self.token, [url], options],
@@ -256,6 +384,15 @@ class Aria2Client:
 
         return result
 
+    def AddUriMany(self, items: List[dict]) -> List[str | None]:
+        # items 为 AddUri 的参数字典 失败时对应位置为 None
+        calls: List[Tuple[str, list]] = []
+        for item in items:
+            item = dict(item)
+            url = item.pop("url")
+            calls.append(("aria2.addUri", [[url], self._MakeAddUriOptions(**item)]))
+        return [result if isinstance(result, str) else None for result in self.Multicall(calls)]
+
     def _Gid_SuccReturnGid(self, method: str, gid: str) -> bool:
         data = self._make_rpcjson(
             method,
@@ -316,6 +453,14 @@ class Aria2Client:
     def UnpauseAll(self) -> bool:
         return self._All_ReturnOK("aria2.unpauseAll")
 
+    def UnpauseMany(self, gids: List[str]) -> List[bool]:
+        results = self.Multicall([("aria2.unpause", [gid]) for gid in gids])
+        return [result == gid for result, gid in zip(results, gids)]
+
+    def ForceRemoveMany(self, gids: List[str]) -> List[bool]:
+        results = self.Multicall([("aria2.forceRemove", [gid]) for gid in gids])
+        return [result == gid for result, gid in zip(results, gids)]
+
     def TellStatus(self, gid: str):
         result = self._post(
             self._make_rpcjson(
@@ -323,11 +468,46 @@ class Aria2Client:
                 [
                     self.token,
                     gid,
-                    ["gid", "status", "totalLength", "completedLength", "downloadSpeed", "dir", "errorCode", "errorMessage"],
+                    self.STATUS_KEYS,
                 ],
             )
         )
-        return RpcStructStatus(**result)
+        return self._MakeStatus(result)
+
+    def TellStatusMany(self, gids: List[str]) -> Dict[str, RpcStructStatus | None]:
+        results = self.Multicall([("aria2.tellStatus", [gid, self.STATUS_KEYS]) for gid in gids])
+        return {gid: (self._MakeStatus(result) if isinstance(result, dict) else None) for gid, result in zip(gids, results)}
+
+    def TellActive(self):
+        results = self._post(self._make_rpcjson("aria2.tellActive", [self.token, self.STATUS_KEYS]))
+        return [self._MakeStatus(result) for result in results]
+
+    def TellWaiting(self, offset: int = 0, num: int = 1000):
+        results = self._post(self._make_rpcjson("aria2.tellWaiting", [self.token, offset, num, self.STATUS_KEYS]))
+        return [self._MakeStatus(result) for result in results]
+
+    def TellStopped(self, offset: int = 0, num: int = 1000):
+        results = self._post(self._make_rpcjson("aria2.tellStopped", [self.token, offset, num, self.STATUS_KEYS]))
+        return [self._MakeStatus(result) for result in results]
+
+    def TellAll(self, num: int = 1000) -> Tuple[Dict[str, RpcStructStatus], RpcStructGlobalStat]:
+        # 一次请求获取所有任务状态和全局状态
+        results = self.Multicall(
+            [
+                ("aria2.tellActive", [self.STATUS_KEYS]),
+                ("aria2.tellWaiting", [0, num, self.STATUS_KEYS]),
+                ("aria2.tellStopped", [0, num, self.STATUS_KEYS]),
+                ("aria2.getGlobalStat", []),
+            ]
+        )
+        for result in results:
+            if isinstance(result, RpcStructFault):
+                raise SyntaxError(f"\n#### Error: \nTellAll = {result} \n####\n")
+        statuses: Dict[str, RpcStructStatus] = {}
+        for result in results[0] + results[1] + results[2]:
+            status = self._MakeStatus(result)
+            statuses[status.gid] = status
+        return statuses, self._MakeGlobalStat(results[3])
 
     def GetFiles(self, gid: str):
         results = self._post(self._make_rpcjson("aria2.getFiles", [self.token, gid]))
@@ -337,9 +517,35 @@ class Aria2Client:
         result: Dict[str, str | int] = self._post(self._make_rpcjson("aria2.getGlobalOption", [self.token]))
         return result
 
+    def ChangeGlobalOption(self, options: Dict[str, str]) -> bool:
+        result = self._post(self._make_rpcjson("aria2.changeGlobalOption", [self.token, options]))
+        return result == "OK"
+
+    def SaveSession(self) -> bool:
+        return self._All_ReturnOK("aria2.saveSession")
+
+    def TellPaths(self, num: int = 1000) -> Dict[str, str]:
+        # 未结束任务的文件路径 -> gid 用于找回恢复的任务
+        keys = ["gid", "files"]
+        results = self.Multicall(
+            [
+                ("aria2.tellActive", [keys]),
+                ("aria2.tellWaiting", [0, num, keys]),
+            ]
+        )
+        paths: Dict[str, str] = {}
+        for result in results:
+            if isinstance(result, RpcStructFault):
+                raise SyntaxError(f"\n#### Error: \nTellPaths = {result} \n####\n")
+            for item in result:
+                for file in item.get("files", []):
+                    if len(file.get("path", "")) != 0:
+                        paths[Path(file["path"]).resolve().as_posix()] = item["gid"]
+        return paths
+
     def GetGlobalStat(self):
         result = self._post(self._make_rpcjson("aria2.getGlobalStat", [self.token]))
-        return RpcStructGlobalStat(**result)
+        return self._MakeGlobalStat(result)
 
     def PurgeDownloadResult(self) -> bool:
         return self._All_ReturnOK("aria2.purgeDownloadResult")
@@ -351,6 +557,10 @@ class Aria2Client:
         except Exception:
             return False
 
+    def RemoveDownloadResultMany(self, gids: List[str]) -> List[bool]:
+        results = self.Multicall([("aria2.removeDownloadResult", [gid]) for gid in gids])
+        return [result == "OK" for result in results]
+
     def GetVersion(self):
         result = self._post(self._make_rpcjson("aria2.getVersion", [self.token]))
         return RpcStructVersion(**result)
@@ -360,6 +570,319 @@ class Aria2Client:
         return RpcStructSessionInfo(**result)
 
 
+class Aria2Notifier:
+    # aria2 WebSocket RPC 通知 https://aria2.github.io/manual/en/html/aria2c.html#notifications
+    ON_START = "aria2.onDownloadStart"
+    ON_PAUSE = "aria2.onDownloadPause"
+    ON_STOP = "aria2.onDownloadStop"
+    ON_COMPLETE = "aria2.onDownloadComplete"
+    ON_ERROR = "aria2.onDownloadError"
+    ON_BT_COMPLETE = "aria2.onBtDownloadComplete"
+
+    _OP_CONTINUATION = 0x0
+    _OP_TEXT = 0x1
+    _OP_BINARY = 0x2
+    _OP_CLOSE = 0x8
+    _OP_PING = 0x9
+    _OP_PONG = 0xA
+
+    def __init__(self, server: str) -> None:
+        self.logger = logger.ObjLogger(self)
+        url = urlsplit(server)
+        self.host: str = url.hostname or "localhost"
+        self.port: int = url.port or 6800
+        self.path: str = "/jsonrpc"
+
+        self._socket: Optional[socket.socket] = None
+        self._buffer: bytes = b""
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = False
+        self._send_lock = threading.Lock()
+        self._callbacks: List[Callable[[str, str], None]] = []
+        self._callbacks_lock = threading.Lock()
+
+    def Subscribe(self, callback: Callable[[str, str], None]):
+        # callback(method, gid) 在通知线程中调用
+        with self._callbacks_lock:
+            self._callbacks.append(callback)
+        return
+
+    def Unsubscribe(self, callback: Callable[[str, str], None]):
+        with self._callbacks_lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+        return
+
+    def isConnected(self) -> bool:
+        return self._thread is not None and self._thread.is_alive() and self._socket is not None
+
+    def Start(self, retry: int = 10) -> bool:
+        if self.isConnected():
+            return True
+        self._stopping = False
+        for i in range(retry):
+            try:
+                self._Connect()
+                break
+            except Exception as e:
+                self.logger.debug(f"WebSocket 连接失败 第 {i + 1} 次 {e}")
+                self._Close()
+                time.sleep(0.2)
+                continue
+        if self._socket is None:
+            self.logger.warn(f"WebSocket 无法连接 ws://{self.host}:{self.port}{self.path} 使用轮询")
+            return False
+        self._thread = threading.Thread(target=self._Loop, daemon=True)
+        self._thread.start()
+        self.logger.debug(f"WebSocket 已连接 ws://{self.host}:{self.port}{self.path}")
+        return True
+
+    def Stop(self):
+        self._stopping = True
+        sock = self._socket
+        if sock is not None:
+            try:
+                self._Send(self._OP_CLOSE, b"")
+            except Exception:
+                pass
+            # 只 close 不能唤醒通知线程中阻塞的 recv
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self._Close()
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+            self._thread = None
+        return
+
+    def _Close(self):
+        if self._socket is None:
+            return
+        try:
+            self._socket.close()
+        except Exception:
+            pass
+        self._socket = None
+        return
+
+    def _Connect(self):
+        key = base64.b64encode(secrets.token_bytes(16)).decode()
+        sock = socket.create_connection((self.host, self.port), timeout=5)
+        self._socket = sock
+        request = (
+            f"GET {self.path} HTTP/1.1\r\n"
+            f"Host: {self.host}:{self.port}\r\n"
+            "Upgrade: websocket\r\n"
+            "Connection: Upgrade\r\n"
+            f"Sec-WebSocket-Key: {key}\r\n"
+            "Sec-WebSocket-Version: 13\r\n"
+            "\r\n"
+        )
+        sock.sendall(request.encode())
+        response = b""
+        while b"\r\n\r\n" not in response:
+            chunk = sock.recv(1024)
+            if len(chunk) == 0:
+                raise ConnectionError("握手时连接关闭")
+            response += chunk
+        head, self._buffer = response.split(b"\r\n\r\n", 1)
+        status = head.split(b"\r\n", 1)[0]
+        if b" 101 " not in status + b" ":
+            raise ConnectionError(f"握手失败 {status.decode(errors='replace')}")
+        sock.settimeout(None)
+        return
+
+    def _RecvExact(self, size: int) -> bytes:
+        assert self._socket is not None
+        while len(self._buffer) < size:
+            chunk = self._socket.recv(max(4096, size - len(self._buffer)))
+            if len(chunk) == 0:
+                raise ConnectionError("连接关闭")
+            self._buffer += chunk
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def _RecvFrame(self) -> Tuple[bool, int, bytes]:
+        b1, b2 = self._RecvExact(2)
+        fin = bool(b1 & 0x80)
+        opcode = b1 & 0x0F
+        size = b2 & 0x7F
+        if size == 126:
+            size = struct.unpack("!H", self._RecvExact(2))[0]
+        elif size == 127:
+            size = struct.unpack("!Q", self._RecvExact(8))[0]
+        mask = self._RecvExact(4) if b2 & 0x80 else None
+        payload = self._RecvExact(size)
+        if mask is not None:
+            payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+        return fin, opcode, payload
+
+    def _Send(self, opcode: int, payload: bytes):
+        # 客户端发送的帧必须使用掩码
+        header = bytes([0x80 | opcode])
+        size = len(payload)
+        if size < 126:
+            header += bytes([0x80 | size])
+        elif size < 65536:
+            header += bytes([0x80 | 126]) + struct.pack("!H", size)
+        else:
+            header += bytes([0x80 | 127]) + struct.pack("!Q", size)
+        mask = secrets.token_bytes(4)
+        masked = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+        with self._send_lock:
+            if self._socket is None:
+                return
+            self._socket.sendall(header + mask + masked)
+        return
+
+    def _Dispatch(self, text: bytes):
+        try:
+            j = json.loads(text)
+        except Exception:
+            return
+        method = j.get("method")
+        if not isinstance(method, str):
+            # 非通知消息 (RPC响应)
+            return
+        with self._callbacks_lock:
+            callbacks = list(self._callbacks)
+        for event in j.get("params", []):
+            gid = event.get("gid") if isinstance(event, dict) else None
+            if gid is None:
+                continue
+            for callback in callbacks:
+                try:
+                    callback(method, gid)
+                except Exception as e:
+                    self.logger.error(f"通知回调错误 {method} {gid} {e}")
+        return
+
+    def _Reconnect(self, retry: int = 10) -> bool:
+        for i in range(retry):
+            self._Close()
+            if self._stopping:
+                return False
+            try:
+                self._Connect()
+                self.logger.info(f"WebSocket 已重新连接 ws://{self.host}:{self.port}{self.path}")
+                return True
+            except Exception as e:
+                self.logger.debug(f"WebSocket 重新连接失败 第 {i + 1} 次 {e}")
+                time.sleep(0.5)
+            continue
+        self._Close()
+        return False
+
+    def _Loop(self):
+        while not self._stopping:
+            self._Receive()
+            if self._stopping:
+                break
+            # 连接意外断开 重新连接 失败时由调用者轮询
+            if not self._Reconnect():
+                self.logger.warn(f"WebSocket 无法重新连接 ws://{self.host}:{self.port}{self.path} 使用轮询")
+                break
+            continue
+        self._Close()
+        return
+
+    def _Receive(self):
+        message = b""
+        try:
+            while self._socket is not None and not self._stopping:
+                fin, opcode, payload = self._RecvFrame()
+                if opcode == self._OP_PING:
+                    self._Send(self._OP_PONG, payload)
+                    continue
+                if opcode == self._OP_PONG:
+                    continue
+                if opcode == self._OP_CLOSE:
+                    break
+                if opcode in (self._OP_TEXT, self._OP_BINARY, self._OP_CONTINUATION):
+                    message += payload
+                    if fin:
+                        self._Dispatch(message)
+                        message = b""
+                continue
+        except Exception as e:
+            if not self._stopping:
+                self.logger.warn(f"WebSocket 连接断开 {e}")
+        return
+
+
+def notifier_test():
+    # 模拟 aria2 的 WebSocket 服务 检查 带掩码的帧 分片消息 ping 断线重连 Stop
+    listener = socket.create_server(("localhost", 0))
+    port = listener.getsockname()[1]
+    events: List[Tuple[str, str]] = []
+    pongs: List[bytes] = []
+    closed = threading.Event()
+    stopped = threading.Event()
+
+    def Frame(opcode: int, payload: bytes, fin: bool = True, masked: bool = False):
+        header = bytes([(0x80 if fin else 0) | opcode, (0x80 if masked else 0) | len(payload)])
+        if not masked:
+            return header + payload
+        mask = secrets.token_bytes(4)
+        return header + mask + bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+
+    def Notify(method: str, gid: str):
+        return json.dumps({"jsonrpc": "2.0", "method": method, "params": [{"gid": gid}]}).encode()
+
+    def Accept():
+        conn, _ = listener.accept()
+        request = b""
+        while b"\r\n\r\n" not in request:
+            request += conn.recv(1024)
+        conn.sendall(b"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n\r\n")
+        return conn
+
+    def ClientFrame(conn: socket.socket):
+        b1, b2 = conn.recv(2)
+        mask = conn.recv(4)
+        payload = conn.recv(b2 & 0x7F)
+        return b1 & 0x0F, bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+
+    def Server():
+        conn = Accept()
+        conn.sendall(Frame(Aria2Notifier._OP_TEXT, Notify(Aria2Notifier.ON_COMPLETE, "1"), masked=True))
+        text = Notify(Aria2Notifier.ON_ERROR, "2")
+        conn.sendall(Frame(Aria2Notifier._OP_TEXT, text[:10], fin=False))
+        conn.sendall(Frame(Aria2Notifier._OP_PING, b"ping"))
+        conn.sendall(Frame(Aria2Notifier._OP_CONTINUATION, text[10:]))
+        pongs.append(ClientFrame(conn)[1])
+        # 断开连接 客户端重新连接
+        conn.shutdown(socket.SHUT_RDWR)
+        conn.close()
+        conn = Accept()
+        conn.sendall(Frame(Aria2Notifier._OP_TEXT, Notify(Aria2Notifier.ON_STOP, "3")))
+        if ClientFrame(conn)[0] == Aria2Notifier._OP_CLOSE:
+            closed.set()
+        # Stop 返回前不关闭连接 通知线程不能依赖服务端断开
+        stopped.wait(5)
+        conn.close()
+
+    threading.Thread(target=Server, daemon=True).start()
+    notifier = Aria2Notifier(f"http://localhost:{port}/jsonrpc")
+    notifier.Subscribe(lambda method, gid: events.append((method, gid)))
+    assert notifier.Start()
+    deadline = time.time() + 10
+    while len(events) < 3 and time.time() < deadline:
+        time.sleep(0.05)
+    begin = time.time()
+    notifier.Stop()
+    stop_time = time.time() - begin
+    stopped.set()
+    listener.close()
+
+    assert events == [(Aria2Notifier.ON_COMPLETE, "1"), (Aria2Notifier.ON_ERROR, "2"), (Aria2Notifier.ON_STOP, "3")], events
+    assert pongs == [b"ping"], pongs
+    assert closed.wait(1)
+    assert stop_time < 0.5, stop_time
+    print(f"notifier_test ok {events} stop={stop_time:.3f}s")
+
+
 def module_test():
     server = Aria2Server("./data/default_download", 20)
     client = Aria2Client("http://localhost:6800", "4XUjiltFc6dMQZmbo8g0Oui1pbvvNhbZ65PmYSBiQG3JuDcQvk39HQFPK8u9NhP1")
@@ -431,4 +954,7 @@ def module_test():
 if __name__ == "__main__":
     os.system("cls")
     os.system("chcp 65001")
-    module_test()
+    if len(sys.argv) > 1 and sys.argv[1] == "notifier":
+        notifier_test()
+    else:
+        module_test()
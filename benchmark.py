@@ -0,0 +1,82 @@
+import sys
+import time
+import tempfile
+
+from pathlib import Path
+from typing import Dict, List
+
+import database
+
+
+def _Prepare(db: database.ComicDatabase, count: int) -> List[int]:
+    pages: Dict[int, database.FileOptional] = {}
+    for page in range(count):
+        pages[page] = database.FileOptional(
+            api_index=0,
+            extension="webp",
+            dl_path="benchmark",
+            dl_url=f"https://example.com/{page:05d}.webp",
+            dl_skip=False,
+            dl_status=database.File.DlStatus.Wait,
+            status=0,
+        )
+    result = db.file.UpsertPages("group", "chapter", pages, database.ChapterOptional(api_index=0, size=count, status=0))
+    return list(result.added.values())
+
+
+def BenchmarkStatusCommit(profile: database.EngineProfile, count: int = 2000) -> float:
+    # 模拟 CopymangaDLManger 的状态更新 CreateTask(Active) + TaskCompleted(Completed)
+    with tempfile.TemporaryDirectory() as temp:
+        db = database.ComicDatabase(Path(temp) / Path("benchmark.db"), profile)
+        indexes = _Prepare(db, count)
+
+        start = time.perf_counter()
+        for index in indexes:
+            file = db.file.ForceIndexGet(index)
+            file.dl_status = database.File.DlStatus.Active
+            db.Commit()
+            db.file.Set_DlStatus_Completed(index)
+            continue
+        elapsed = time.perf_counter() - start
+
+        db.Close()
+
+    return (count * 2) / elapsed
+
+
+def BenchmarkStatusJournal(profile: database.EngineProfile, count: int = 2000) -> float:
+    # 同上 状态变化写入 StatusJournal 批量提交
+    with tempfile.TemporaryDirectory() as temp:
+        db = database.ComicDatabase(Path(temp) / Path("benchmark.db"), profile)
+        indexes = _Prepare(db, count)
+
+        start = time.perf_counter()
+        for index in indexes:
+            db.journal.Set(index, dl_status=database.File.DlStatus.Active)
+            db.journal.Set(index, dl_status=database.File.DlStatus.Completed)
+            db.journal.Tick()
+            continue
+        db.Flush()
+        elapsed = time.perf_counter() - start
+
+        db.Close()
+
+    return (count * 2) / elapsed
+
+
+def module_benchmark():
+    count = int(sys.argv[1], 10) if len(sys.argv) > 1 else 2000
+    profiles = {
+        "legacy": database.EngineProfile.Legacy(),
+        "default": database.EngineProfile.Default(),
+    }
+    for name, profile in profiles.items():
+        rate = BenchmarkStatusCommit(profile, count)
+        print(f"{name:8s} {rate:10.1f} commits/s {profile}")
+    rate = BenchmarkStatusJournal(profiles["default"], count)
+    print(f"{'journal':8s} {rate:10.1f} changes/s")
+    return
+
+
+if __name__ == "__main__":
+    module_benchmark()
@@ -4,67 +4,75 @@ import time
 import datetime
 import requests
 import threading
+import requests.adapters
 
-from typing import Dict, List, Optional, Sequence, Tuple
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from pathlib import Path
 from pydantic import BaseModel
 
 import database
+import httpcache
+import ratelimit
+import scanner
 import spdlogger
 
 from uuid import UUID
 
 logger = spdlogger.logger
 
+try:
+    import httpx
+    import h2  # noqa: F401 httpx 的 HTTP/2 支持依赖 h2
+except ImportError:
+    httpx = None
 
-class ApiRequsetLock:
-    def __init__(self, num: int) -> None:
-        self._queue: List[datetime.datetime] = []
-        self._lock = threading.Lock()
-        self._num = num
 
-    def ReleaseTime(self):
-        if len(self._queue) == 0:
-            return 0
-        return (self._queue[0] - datetime.datetime.now()).seconds
+globle_copymanga_api_lock = ratelimit.globle_rate_limiters.Get("api.mangacopy.com", 15)
 
-    def Reset(self):
-        self._queue.clear()
 
-    def Ready(self) -> bool:
-        self._lock.acquire()
-        ret = True
-        while len(self._queue) >= self._num:
-            if self._queue[0] > datetime.datetime.now():
-                ret = False
-                break
-            self._queue.pop(0)
-            ret = True
-            break
-        self._lock.release()
-        return ret
-
-    def CountAdd(self):
-        self._lock.acquire()
-        self._queue.append(datetime.datetime.now() + datetime.timedelta(seconds=61))
-        self._lock.release()
-
-    def Refresh(self):
-        self._lock.acquire()
-        while len(self._queue) != 0:
-            if self._queue[0] > datetime.datetime.now():
-                break
-            self._queue.pop(0)
-            continue
-        self._lock.release()
+class ApiSession:
+    def __init__(self, proxy: Optional[str], pool_size: int = 8, http2: bool = True) -> None:
+        # 连接池复用 TCP+TLS 连接 可用时使用 HTTP/2
+        self.proxy = proxy
+        self.http2 = http2 and httpx is not None
+
+        if self.http2:
+            self._client = httpx.Client(
+                http2=True,
+                proxy=None if proxy is None else f"http://{proxy}",
+                limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+                timeout=30,
+            )
+            return
+
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self._client = requests.Session()
+        self._client.mount("https://", adapter)
+        self._client.mount("http://", adapter)
+        if proxy is not None:
+            self._client.proxies = {"https": f"http://{proxy}"}
         return
 
     def __str__(self) -> str:
-        self.Refresh()
-        return f"{len(self._queue)}/{self._num}"
+        return f"<{ApiSession.__name__} proxy={self.proxy} http2={self.http2} />"
 
+    def Get(self, url: str, header: dict):
+        return self._client.get(url, headers=header, timeout=30)
 
-globle_copymanga_api_lock = ApiRequsetLock(15)
+
+globle_api_sessions: Dict[Optional[str], ApiSession] = {}
+globle_api_sessions_lock = threading.Lock()
+
+
+def GetApiSession(proxy: Optional[str]) -> ApiSession:
+    # 相同代理的所有漫画共享连接池
+    with globle_api_sessions_lock:
+        session = globle_api_sessions.get(proxy)
+        if session is None:
+            session = ApiSession(proxy)
+            globle_api_sessions[proxy] = session
+        return session
 
 
 class ApiSearchComic(BaseModel):
@@ -287,7 +295,7 @@ class ComicFilePath:
         return f"{group}/{index:04d}.{chapter}-{page_str}.{ext}"
 
     @staticmethod
-    def AtDownloadDir_ORM(file: database.FileORM):
+    def AtDownloadDir_ORM(file: database.FileORM | database.File):
         return ComicFilePath.AtDownloadDir(
             file.group,
             file.api_index,
@@ -316,11 +324,12 @@ class CopymangaObject:
         pathword: Optional[str] = None,
         keyword: Optional[str] = None,
         proxy: Optional[str] = None,
+        offline: bool = False,
+        fresh: bool = False,
     ) -> None:
         self.logger = logger.ObjLogger(self)
 
         self.host: str = "mangacopy.com"
-        self.proxy: Optional[dict] = None
         self.header = {
             "User-Agent": "duoTuoCartoon/3.2.4 (iPhone; iOS 18.0.1; Scale/3.00) iDOKit/1.0.0 RSSX/1.0.0",
             "version": "2025.10.12",
@@ -334,9 +343,37 @@ class CopymangaObject:
 
         if proxy is not None:
             self.logger.info(f"使用系统代理 {proxy}")
-            self.proxy = {"https": f"http://{proxy}"}
 
         self.lock = globle_copymanga_api_lock
+        # 代理只在共享的 ApiSession 中配置
+        self.session = GetApiSession(proxy)
+        # 同时进行的章节文件请求数
+        self.workers: int = 4
+        # 新记录文件的回调 用于更新同时下载
+        self.on_file_added: Optional[Callable[[int], None]] = None
+        # 设置后 等待API请求数的请求立即结束
+        self.cancel: Optional[threading.Event] = None
+        # 更新时 不读取漫画信息和章节列表的响应缓存 结果仍写入缓存
+        self.fresh = fresh
+        # 漫画信息 离线模式时在第一次使用时获取
+        self._data: Optional[ApiGetComic.Results] = None
+
+        # 离线模式 只使用本地数据库中的名称和分组
+        if offline:
+            if pathword is None:
+                raise ValueError(f"离线模式需要路径词 keyword=[{keyword}]")
+            self.pathword = pathword
+            self._db_file = database_root / Path(f"{pathword}.db")
+            if not self._db_file.exists():
+                raise ValueError(f"数据库不存在 {self._db_file.as_posix()}")
+            self.database = database.ComicDatabase(self._db_file)
+            # 没有记录名称的数据库 (未完成的首次更新) 不能确定下载目录
+            name = self.database.attribute.SelectTag(self.database.attribute.METADATA_NAME_TAG)
+            if name is None or not name.name:
+                self.database.Close()
+                raise ValueError(f"数据库没有记录漫画名称 {self._db_file.as_posix()}")
+            self.download_folder = download_root / Path(name.name)
+            return
 
         # 如果用 关键词 为参数
         if pathword is None and isinstance(keyword, str):
@@ -357,10 +394,8 @@ class CopymangaObject:
         if data is None:
             raise ValueError(f"路径词(pathword={pathword})不存在")
 
-        self.data = data
-
-        self.groups: Dict[str, ApiGetComic.Results.GroupsMetadata] = self.data.groups
-        self.comic: ApiGetComic.Results.ComicInfo = self.data.comic
+        self._data = data
+        self.pathword = data.comic.path_word
 
         # 初始化 漫画本地数据库和目录
         self.download_folder = download_root / Path(self.data.comic.name)
@@ -370,22 +405,58 @@ class CopymangaObject:
 
         return
 
-    def Get(self, url, msg: str = "") -> dict:
-        while not self.lock.Ready():
-            self.logger.debug(f"等待API请求数 {self.lock.ReleaseTime()}s")
-            time.sleep(10)
+    @property
+    def data(self) -> ApiGetComic.Results:
+        if self._data is None:
+            self.logger.info(f"获取漫画信息 {self.pathword}")
+            data = self.GetInfo(self.pathword)
+            if data is None:
+                raise ValueError(f"路径词(pathword={self.pathword})不存在")
+            self._data = data
+            self._CheckMetadata()
+        return self._data
+
+    @property
+    def groups(self) -> Dict[str, ApiGetComic.Results.GroupsMetadata]:
+        return self.data.groups
+
+    @property
+    def comic(self) -> ApiGetComic.Results.ComicInfo:
+        return self.data.comic
+
+    def IsOffline(self) -> bool:
+        return self._data is None
+
+    def Get(self, url, msg: str = "", store: bool = True, fresh: Optional[bool] = None) -> dict:
+        # 缓存命中时不占用API请求数 store=False 时由调用者检查结果后再写入缓存
+        # fresh 为 None 时使用 self.fresh
+        if fresh is None:
+            fresh = self.fresh
+        cache = httpcache.globle_response_cache
+        if cache is not None:
+            cached = None if fresh and not cache.CacheOnly() else cache.Get(url)
+            if cached is not None:
+                self.logger.debug(f"{msg}缓存 {url}")
+                return cached
+            if cache.CacheOnly():
+                raise ConnectionError(f"{msg}仅使用缓存 没有缓存 {url}")
 
         err = 0
 
         while True:
+            wait = self.lock.ReleaseTime()
+            if wait > 0:
+                self.logger.debug(f"等待API请求数 {wait:.1f}s")
+            self.AcquireApi(url, msg)
             try:
-                self.lock.CountAdd()
                 self.logger.debug(f"{msg}请求 {url} 请求数({self.lock})")
-                r = requests.get(url, headers=self.header, proxies=self.proxy)
+                r = self.session.Get(url, self.header)
 
                 if r.status_code < 200 or r.status_code > 299:
                     raise ConnectionError(f"{msg}请求失败 HTTP {r.status_code}")
 
+                j: dict = r.json()
+
             except Exception as e:
                 err += 1
                 self.logger.warn(f"{msg}重试第 {err} 次")
@@ -395,11 +466,11 @@ class CopymangaObject:
                     raise ConnectionError(f"{msg}无法请求 {url} ")
                 continue
 
-            throttled_sec = self.CheckThrottled(r.json())
+            throttled_sec = self.CheckThrottled(j)
 
             if throttled_sec is None:
-                if r.json().get("results") is None:
-                    self.logger.error(f"{msg}结构错误 {r.json()}")
+                if j.get("results") is None:
+                    self.logger.error(f"{msg}结构错误 {j}")
                     continue
                 break
 
@@ -410,10 +481,35 @@ class CopymangaObject:
             self.lock.Reset()
             continue
 
-        results = self.GetResults(r.json())
+        results = self.GetResults(j)
+
+        if cache is not None and store:
+            cache.Put(url, results)
 
         return results
 
+    def AcquireApi(self, url: str, msg: str = ""):
+        # 等待API请求数 取消时抛出 InterruptedError
+        while True:
+            if self.cancel is not None and self.cancel.is_set():
+                raise InterruptedError(f"{msg}已取消 {url}")
+            if self.lock.TryAcquire():
+                return
+            self.lock.WaitReady(1.0)
+            continue
+
+    def StoreResponse(self, url: str, results: dict):
+        cache = httpcache.globle_response_cache
+        if cache is not None:
+            cache.Put(url, results)
+        return
+
+    def DropResponse(self, url: str):
+        cache = httpcache.globle_response_cache
+        if cache is not None:
+            cache.Delete(url)
+        return
+
     def CheckThrottled(self, j: dict):
         code = j.get("code")
         if code is None:
@@ -515,7 +611,22 @@ class CopymangaObject:
             return None
         return results
 
+    def ShowLocalMetadate(self) -> None:
+        self.logger.info(f"漫画 {self.pathword} 本地信息")
+        self.logger.info(f"| 名称 [ {self.database.attribute.GetName()} ]")
+        self.logger.info(f"| 目录 [ {self.download_folder.as_posix()} ]")
+        updated = self.database.attribute.GetUpdated()
+        if updated is not None:
+            self.logger.info(f"| 更新 [ {updated[0]} ]")
+        self.logger.info(f"| 数据 [ {self.database.engine} ]")
+        for index, group in enumerate(self.database.group.GetAll()):
+            count = self.database.group.GetCount(group.name)
+            self.logger.info(f"| 分组{index} [ {group.name} {'?' if count is None else count} {group.value} ]")
+        return
+
     def ShowMetadate(self) -> None:
+        if self.IsOffline():
+            return self.ShowLocalMetadate()
         groups = self.groups
         comic = self.comic
         self.logger.info(f"漫画 {comic.path_word} 信息")
@@ -536,20 +647,22 @@ class CopymangaObject:
     def GetFiles(self, chapter: ApiGetChapters.Results.ChaptersMetadata) -> Dict[int, str] | None:
         comic = self.comic
 
-        results = ApiGetFiles.Results(
-            **self.Get(
-                f"https://api.{self.host}/api/v3/comic/{comic.path_word}/chapter2/{chapter.uuid}",
-                "|   ",
-            )
-        )
+        # 章节上传中时文件数量不完整 检查通过后才写入缓存
+        url = f"https://api.{self.host}/api/v3/comic/{comic.path_word}/chapter2/{chapter.uuid}"
+        # 章节文件列表发布后基本不变 更新时也使用缓存
+        j = self.Get(url, "|   ", store=False, fresh=False)
+        results = ApiGetFiles.Results(**j)
 
         words = results.chapter.words
         contents = results.chapter.contents
 
         if not (len(words) == len(contents) == chapter.size):
             self.logger.error(f"数量不一致")
+            self.DropResponse(url)
             return None
 
+        self.StoreResponse(url, j)
+
         files: Dict[int, str] = {}
 
         for page, content in sorted(zip(words, contents)):
@@ -557,246 +670,278 @@ class CopymangaObject:
 
         return files
 
-    def GetChapters(self, group: ApiGetComic.Results.GroupsMetadata) -> List[ApiGetChapters.Results.ChaptersMetadata]:
+    def GetChaptersPage(self, group: ApiGetComic.Results.GroupsMetadata, offset: int, limit: int = 100) -> ApiGetChapters.Results:
+        return ApiGetChapters.Results(
+            **self.Get(
+                f"https://api.{self.host}/api/v3/comic/{self.data.comic.path_word}/group/{group.path_word}/chapters"  #
+                + f"?limit={limit}&offset={offset}&platform=3",
+                "| ",
+            )
+        )
+
+    def GetChaptersTail(self, group: ApiGetComic.Results.GroupsMetadata) -> Optional[Tuple[List[ApiGetChapters.Results.ChaptersMetadata], int]]:
+        # 从本地最后一个章节开始获取 返回 (章节, 章节列表总数) 数据不一致时返回 None 需要完整获取
+        rows = self.database.chapter.GetGroupIndexRows(group.name)
+        if len(rows) == 0:
+            return None
+        for position, row in enumerate(rows):
+            if row.api_index != position:
+                self.logger.warn(f"| 本地章节序号不连续 [{position}] != [{row.api_index}] 完整获取")
+                return None
+
+        # 与最后一个已记录章节重叠一个 用于确认顺序没有变化
+        offset = len(rows) - 1
+        limit = 100
+        chapters: List[ApiGetChapters.Results.ChaptersMetadata] = []
+        while True:
+            results = self.GetChaptersPage(group, offset + len(chapters), limit)
+            total = int(results.total)
+            if total < len(rows):
+                self.logger.warn(f"| 章节总数 {total} 少于本地记录 {len(rows)} 完整获取")
+                return None
+            if len(results.list) == 0:
+                self.logger.warn(f"| 章节列表为空 offset={offset + len(chapters)} total={total} 完整获取")
+                return None
+            for chapter in results.list:
+                if chapter.index != offset + len(chapters):
+                    self.logger.warn(f"| 章节序号不连续 [{offset + len(chapters)}] != [{chapter.index}] 完整获取")
+                    return None
+                chapters.append(chapter)
+                continue
+            if chapters[0].uuid != rows[-1].uuid:
+                self.logger.warn(f"| 章节 [{offset}] {chapters[0].name} 与本地记录不一致 完整获取")
+                return None
+            if offset + len(chapters) >= total:
+                break
+            continue
+
+        self.logger.info(f"| 从第 {offset} 个章节开始获取 共 {len(chapters)} 个")
+        return chapters, total
+
+    def GetChapters(self, group: ApiGetComic.Results.GroupsMetadata, full: bool = False) -> Tuple[List[ApiGetChapters.Results.ChaptersMetadata], int]:
+        # 返回 (章节, 章节列表总数) 总数可能与漫画信息中的分组章节数不同
+        if not full:
+            tail = self.GetChaptersTail(group)
+            if tail is not None:
+                return tail
         offset = 0
         limit = 100
+        total = 0
         chapters: List[ApiGetChapters.Results.ChaptersMetadata] = []
         while True:
-            results = ApiGetChapters.Results(
-                **self.Get(
-                    f"https://api.{self.host}/api/v3/comic/{self.data.comic.path_word}/group/{group.path_word}/chapters"  #
-                    + f"?limit={limit}&offset={offset}&platform=3",
-                    "| ",
-                )
-            )
+            results = self.GetChaptersPage(group, offset, limit)
             chapters += results.list
+            total = int(results.total)
             offset += limit
-            if len(chapters) >= int(results.total):
+            if len(chapters) >= total:
                 break
             continue
-        return chapters
-
-    def UpdateGroup(self, group: ApiGetComic.Results.GroupsMetadata, not_files=False) -> int:
-        comic = self.comic
-
-        # ================================================================================================================================
+        return chapters, total
 
-        def CheckChapterCompleted(
-            group: ApiGetComic.Results.GroupsMetadata,
-            chapter: ApiGetChapters.Results.ChaptersMetadata,
-        ) -> bool:
-            orm_chapter = self.database.chapter.SelectUUID(chapter.uuid)
-
-            # 章节 已完成
-            if orm_chapter is None:
+    def IsUnchanged(self) -> bool:
+        # 更新时间 最新章节 各分组章节数 都与上次完整更新一致
+        updated = (self.comic.datetime_updated, str(self.comic.last_chapter.uuid))
+        if self.database.attribute.GetUpdated() != updated:
+            return False
+        for group in self.groups.values():
+            if self.database.group.GetCount(group.name) != group.count:
                 return False
+            continue
+        return True
 
-            # 检查 本地文件数量
-            local_files = self.download_folder.glob(
-                ComicFilePath.AtDownloadDir(
-                    group.name,
-                    chapter.index,
-                    chapter.name,
-                    "*",
-                    "*",
-                ),
-            )
-
-            local_count = len(list(local_files))
-            loss_count = chapter.size - local_count
+    def CheckChapterCompleted(
+        self,
+        chapter: ApiGetChapters.Results.ChaptersMetadata,
+        local_chapters: Dict[int, List[str]],
+    ) -> bool:
+        orm_chapter = self.database.chapter.SelectUUID(chapter.uuid)
 
-            if loss_count == 0:
-                self.logger.info(f"| 文件完整 {chapter.size:03d} [{orm_chapter.index:03d}] {chapter.name}")
-            else:
-                self.logger.info(f"| 文件缺少 {chapter.size - local_count:03d} 个 [{orm_chapter.index:03d}] {chapter.name}")
-
-            return True
-
-        # ================================================================================================================================
-
-        def InsertFile(
-            group: ApiGetComic.Results.GroupsMetadata,
-            chapter: ApiGetChapters.Results.ChaptersMetadata,
-            page: int,
-            url: str,
-        ) -> int:
-            extension = url[url.rfind(".") + 1 :]
-            fullpath = ComicFilePath.AtDownloadDir(
-                group.name,
-                chapter.index,
-                chapter.name,
-                page,
-                extension,
-            )
+        # 章节 已完成
+        if orm_chapter is None:
+            return False
 
-            orm_file = self.database.file.SelectPage(
-                group.name,
-                chapter.name,
-                page,
-            )
+        # 检查 本地文件数量
+        local_count = scanner.CountChapterPages(local_chapters, chapter.index, chapter.name)
+        loss_count = chapter.size - local_count
 
-            # 文件 更新URL
-            if orm_file is not None:
-                if orm_file.dl_skip:
-                    self.logger.debug(f"|   跳过更新 {orm_file.index:04d} {fullpath}")
-                    return orm_file.index
-                orm_file.dl_url = url
-                orm_file.extension = extension
-                orm_file.dl_status = database.File.DlStatus.Update
-                self.database.Commit()
-                self.logger.debug(f"|   更新文件 {orm_file.index:04d} {fullpath} {orm_file.dl_url}")
-                return orm_file.index
-
-            # 文件 无任务
-
-            orm_file = self.database.file.AddPage(
-                group.name,
-                chapter.name,
-                page,
-                database.FileOptional(
-                    api_index=chapter.index,
-                    extension=extension,
-                    dl_path=comic.name,
-                    dl_url=url,
-                    dl_skip=False,
-                    dl_status=database.File.DlStatus.Wait,
-                    status=0,
-                ),
-            )
-
-            self.logger.info(f"|   记录文件 {orm_file.index:04d} + {fullpath}")
-            return orm_file.index
+        if loss_count == 0:
+            self.logger.info(f"| 文件完整 {chapter.size:03d} [{orm_chapter.index:03d}] {chapter.name}")
+        else:
+            self.logger.info(f"| 文件缺少 {chapter.size - local_count:03d} 个 [{orm_chapter.index:03d}] {chapter.name}")
 
-        # ================================================================================================================================
+        return True
 
-        def InsertFiles(
-            group: ApiGetComic.Results.GroupsMetadata,
-            chapter: ApiGetChapters.Results.ChaptersMetadata,
-            files: Dict[int, str],
-        ) -> int:
-            # 记录文件
-            for page in files.keys():
-                url = files[page]
-                InsertFile(group, chapter, page, url)
-                continue
-
-            # 标记章节完成
-            orm_chapter = self.database.chapter.AddName(
-                group.name,
-                chapter.name,
-                database.ChapterOptional(
-                    api_index=chapter.index,
-                    size=chapter.size,
-                    uuid=chapter.uuid,
-                    status=0,
-                ),
+    def InsertFiles(
+        self,
+        group: ApiGetComic.Results.GroupsMetadata,
+        chapter: ApiGetChapters.Results.ChaptersMetadata,
+        files: Dict[int, str],
+    ) -> int:
+        comic = self.comic
+        pages: Dict[int, database.FileOptional] = {}
+        for page, url in files.items():
+            pages[page] = database.FileOptional(
+                api_index=chapter.index,
+                extension=url[url.rfind(".") + 1 :],
+                dl_path=comic.name,
+                dl_url=url,
+                dl_skip=False,
+                dl_status=database.File.DlStatus.Wait,
+                status=0,
             )
 
-            self.logger.info(f"|   [{orm_chapter.index:04d}] 完成")
+        # 记录文件 标记章节完成
+        result = self.database.file.UpsertPages(
+            group.name,
+            chapter.name,
+            pages,
+            database.ChapterOptional(
+                api_index=chapter.index,
+                size=chapter.size,
+                uuid=chapter.uuid,
+                status=0,
+            ),
+        )
 
-            return len(files)
+        def FullPath(page: int):
+            return ComicFilePath.AtDownloadDir(group.name, chapter.index, chapter.name, page, str(pages[page].extension))
+
+        for page, index in result.skipped.items():
+            self.logger.debug(f"|   跳过更新 {index:04d} {FullPath(page)}")
+        for page, index in result.updated.items():
+            self.logger.debug(f"|   更新文件 {index:04d} {FullPath(page)} {files[page]}")
+        for page, index in result.added.items():
+            self.logger.info(f"|   记录文件 {index:04d} + {FullPath(page)}")
+            if self.on_file_added is not None:
+                self.on_file_added(index)
+
+        self.logger.info(f"|   [{result.chapter:04d}] 完成")
+
+        return len(files)
+
+    def PlanGroup(
+        self, group: ApiGetComic.Results.GroupsMetadata, force=False
+    ) -> Optional[Tuple[List[ApiGetChapters.Results.ChaptersMetadata], int]]:
+        # 返回 (需要获取文件列表的章节, 章节列表总数) 分组无更新时返回 None
+        # 章节数与上次完整更新一致 不请求章节列表
+        if not force and self.database.group.GetCount(group.name) == group.count:
+            self.logger.info(f"分组 [ {group.name} ] 共 {group.count} 个章节 无更新 跳过")
+            return None
 
-        # ================================================================================================================================
+        self.logger.info(f"获取分组 [ {group.name} ] 共 {group.count} 个章节")
+        # 强制更新时完整获取
+        chapters, total = self.GetChapters(group, full=force)
+        if total != group.count:
+            self.logger.warn(f"| 章节列表共 {total} 个章节 与漫画信息 {group.count} 个不一致")
+
+        # 检查章节已完成 分组目录只扫描一次
+        local_chapters = scanner.ComicDirIndex(self.download_folder / Path(group.name), 1).Scan().Chapters("")
+        new_chapters: List[ApiGetChapters.Results.ChaptersMetadata] = []
+        for chapter in chapters:
+            if self.CheckChapterCompleted(chapter, local_chapters):
+                continue
+            new_chapters.append(chapter)
+            continue
+        return new_chapters, total
 
-        def PrintChapters(chapters: List[ApiGetChapters.Results.ChaptersMetadata]):
-            for chapter in chapters:
-                self.logger.info(f"| {chapter.index:04d}. {chapter.name}({chapter.size})")
+    def FinishGroup(self, group: ApiGetComic.Results.GroupsMetadata, total: int, total_update: int, total_files: int, total_failed: int):
+        if total_files == 0:
+            self.logger.debug(f"| [ {group.name} ] 本地记录已是最新")
+        else:
+            self.logger.info(f"| [ {group.name} ] 记录 {total_update} 个章节 {total_files} 个文件")
+
+        # 全部章节记录成功才保存章节数 失败的章节下次重新获取
+        if total_failed != 0:
+            return
+        # 漫画信息与章节列表不是同时获取的 章节数都一致时才保存 否则下次重新获取
+        local = self.database.chapter.CountGroup(group.name)
+        if total != group.count or local != group.count:
+            self.logger.warn(f"| [ {group.name} ] 章节数不一致 漫画信息 {group.count} 章节列表 {total} 本地 {local} 下次重新获取")
+            return
+        self.database.group.SetCount(group.name, total)
+        return
 
-        # ================================================================================================================================
-        def Update() -> int:
-            total_files = 0
-            total_update = 0
+    def FinishUpdate(self, files_count: int):
+        if all(self.database.group.GetCount(group.name) == group.count for group in self.groups.values()):
+            self.database.attribute.SetUpdated(self.comic.datetime_updated, str(self.comic.last_chapter.uuid))
+        self.logger.info(f"更新完成 共记录 {files_count} 个文件")
+        return
 
+    def UpdateGroup(self, group: ApiGetComic.Results.GroupsMetadata, not_files=False, force=False) -> int:
+        # 仅显示在线章节目录
+        if not_files:
             self.logger.info(f"获取分组 [ {group.name} ] 共 {group.count} 个章节")
-            chapters = self.GetChapters(group)
-
-            # 仅显示在线章节目录
-            if not_files:
-                PrintChapters(chapters)
-                return 0
-
+            chapters, _ = self.GetChapters(group, full=True)
             for chapter in chapters:
-                # 检查章节已完成
-                if CheckChapterCompleted(group, chapter):
-                    continue
+                self.logger.info(f"| {chapter.index:04d}. {chapter.name}({chapter.size})")
+            return 0
 
-                # 获取章节文件列表
-                self.logger.info(f"| + 章节({chapter.name})")
-                files = self.GetFiles(chapter)
-                if files is None:
-                    self.logger.error(f"|   获取文件失败")
-                    continue
-                files_count = InsertFiles(group, chapter, files)
+        crawler = ChapterCrawler(self.workers)
+        crawler.AddGroup(self, group, force)
+        return crawler.Run()
 
-                # 更新计数
-                total_files += files_count
-                total_update += 1
+    def UpdateAll(self, not_files=False, force=False):
+        if not_files:
+            for group in self.groups.values():
+                self.UpdateGroup(group, not_files=True)
                 continue
-
-            if total_files == 0:
-                self.logger.debug(f"| 本地记录已是最新")
-            else:
-                self.logger.info(f"| 记录 {total_update} 个章节 {total_files} 个文件")
-
-            return total_update
-
-        return Update()
-
-    def UpdateAll(self, not_files=False):
-        files_count = 0
-        for group in self.groups.values():
-            files_count += self.UpdateGroup(group, not_files)
-            continue
-        if not_files is False:
-            self.logger.info(f"更新完成 共记录 {files_count} 个文件")
-        else:
             self.logger.info(f"获取完成")
+            return
+
+        crawler = ChapterCrawler(self.workers)
+        crawler.Add(self, force)
+        crawler.Run()
         return
 
+    def DirIndex(self):
+        # 一次扫描下载目录 按目录并行
+        return scanner.ComicDirIndex(self.download_folder, self.workers * 2).Scan()
+
     def DetectFiles(self):
-        items = self.database.file.GetAll(database.FileOptional())
+        items = self.database.file.GetPathRows(database.FileOptional())
         self.logger.info(f"检查所有 {len(items)} 个文件的完成状态")
+        index = self.DirIndex()
+        marks: List[int] = []
         for item in items:
-            filepath = self.download_folder / ComicFilePath.AtDownloadDir(
-                item.group,
-                item.index,
-                item.chapter,
-                item.page,
-                item.extension,
-            )
-            if not filepath.exists():
+            if item.dl_status == database.File.DlStatus.Completed:
                 continue
-            self.logger.info(f'| 标记 {item.index:04d} "{filepath.as_posix()}" 为已下载')
-            item.dl_status = database.File.DlStatus.Completed
-            self.database.Commit()
+            filepath = ComicFilePath.AtDownloadDir_ORM(item)
+            if not index.Exists(filepath):
+                continue
+            self.logger.info(f'| 标记 {item.index:04d} "{(self.download_folder / filepath).as_posix()}" 为已下载')
+            marks.append(item.index)
             continue
-        self.logger.info(f"文件检查完成")
+        self.database.file.UpdateIndexes(marks, database.FileOptional(dl_status=database.File.DlStatus.Completed))
+        self.logger.info(f"文件检查完成 标记 {len(marks)} 个文件")
         return
 
     def CheckFiles(self, mark_removed_file: bool = False):
-        items = self.database.file.All_Completed_DlStatus()
+        items = self.database.file.GetPathRows(database.FileOptional(dl_status=database.File.DlStatus.Completed))
         self.logger.info(f"检查已完成的 {len(items)} 个文件")
+        index = self.DirIndex()
+        removed: List[int] = []
         for item in items:
-            filepath = self.download_folder / ComicFilePath.AtDownloadDir_ORM(item)
-            if filepath.exists():
+            filepath = ComicFilePath.AtDownloadDir_ORM(item)
+            if index.Exists(filepath):
                 continue
             if mark_removed_file:
-                self.logger.warn(f'| 文件丢失 "{filepath.as_posix()}" 将标记为跳过下载')
-                item.dl_skip = True
-                self.database.Commit()
-                continue
-            self.logger.warn(f'| 文件丢失 "{filepath.as_posix()}" 将标记为未下载')
-            item.dl_status = 0
-            self.database.Commit()
+                self.logger.warn(f'| 文件丢失 "{(self.download_folder / filepath).as_posix()}" 将标记为跳过下载')
+            else:
+                self.logger.warn(f'| 文件丢失 "{(self.download_folder / filepath).as_posix()}" 将标记为未下载')
+            removed.append(item.index)
             continue
+        if mark_removed_file:
+            self.database.file.UpdateIndexes(removed, database.FileOptional(dl_skip=True))
+        else:
+            self.database.file.UpdateIndexes(removed, database.FileOptional(dl_status=database.File.DlStatus.Wait))
 
-        items = self.database.file.All_Active_DlStatus()
-        self.logger.info(f"未完成共 {len(items)} 个文件")
-        items = self.database.file.All_Wait_DlStatus()
+        count = self.database.file.Count(database.FileOptional(dl_status=database.File.DlStatus.Active))
+        self.logger.info(f"未完成共 {count} 个文件")
 
-        self.logger.info(f"未开始共 {len(items)} 个文件")
-        items = self.database.file.All_Error_DlStatus()
+        count = self.database.file.Count(database.FileOptional(dl_status=database.File.DlStatus.Wait))
+        self.logger.info(f"未开始共 {count} 个文件")
 
+        items = self.database.file.GetPathRows(database.FileOptional(dl_status=database.File.DlStatus.Error))
         self.logger.info(f"错误共 {len(items)} 个文件")
         for item in items:
             filepath = self.download_folder / ComicFilePath.AtDownloadDir_ORM(item)
@@ -805,6 +950,198 @@ class CopymangaObject:
         self.logger.info(f"文件检查完成")
         return
 
+    def VerifyFiles(self):
+        items = self.database.file.GetPathRows(database.FileOptional(dl_status=database.File.DlStatus.Completed))
+        self.logger.info(f"校验已完成的 {len(items)} 个文件")
+
+        def Verify(item):
+            filepath = self.download_folder / ComicFilePath.AtDownloadDir_ORM(item)
+            try:
+                st = os.stat(filepath)
+            except FileNotFoundError:
+                return item, filepath, None, False
+            # 大小和修改时间未变化 跳过
+            if len(item.hash) != 0 and item.size == st.st_size and item.mtime == st.st_mtime_ns:
+                return item, filepath, False, True
+            # 没有记录时 首次记录前检查图片是否完整
+            intact = len(item.hash) != 0 or scanner.ImageIntact(filepath)
+            return item, filepath, scanner.FileManifest(filepath, item.hash), intact
+
+        with ThreadPoolExecutor(max_workers=self.workers * 2) as executor:
+            results = list(executor.map(Verify, items))
+
+        rows: List[dict] = []
+        recorded = 0
+        for item, filepath, manifest, intact in results:
+            if manifest is False:
+                continue
+            if manifest is None:
+                self.logger.warn(f'| 文件丢失 "{filepath.as_posix()}" 将标记为未下载')
+                rows.append({"index": item.index, "dl_status": database.File.DlStatus.Wait, **database.FILE_MANIFEST_CLEAR})
+                continue
+            size, mtime, digest = manifest
+            if size == 0 or not intact or (len(item.hash) != 0 and scanner.SameAlgorithm(item.hash, digest) and digest != item.hash):
+                self.logger.warn(f'| 文件损坏 "{filepath.as_posix()}" 将标记为未下载')
+                rows.append({"index": item.index, "dl_status": database.File.DlStatus.Wait, **database.FILE_MANIFEST_CLEAR})
+                continue
+            # 首次记录 或 修改时间变化但内容相同
+            rows.append({"index": item.index, "size": size, "mtime": mtime, "hash": digest})
+            recorded += 1
+            continue
+
+        self.database.file.UpdateRows(rows)
+        self.logger.info(f"校验完成 记录 {recorded} 个文件 重新下载 {len(rows) - recorded} 个文件")
+        return
+
+
+class ChapterCrawler:
+    # 多个漫画 多个分组的章节文件列表在一个线程池中同时请求 请求速度只受共用的API请求数限制
+    # 数据库只在调用 Add/Run 的线程中写入 每规划完一个漫画 写入已完成的章节
+    class _ComicState:
+        def __init__(self, comic: CopymangaObject) -> None:
+            self.comic = comic
+            self.files = 0
+            self.pending = 0
+            # 所有分组已规划 章节全部写入后可以保存更新记录
+            self.planned = False
+
+    class _GroupState:
+        def __init__(self, parent: "ChapterCrawler._ComicState", group: ApiGetComic.Results.GroupsMetadata, total: int, pending: int) -> None:
+            self.parent = parent
+            self.comic = parent.comic
+            self.group = group
+            # 章节列表总数
+            self.total = total
+            self.pending = pending
+            self.update = 0
+            self.files = 0
+            self.failed = 0
+
+    def __init__(self, workers: int = 4) -> None:
+        self.logger = logger.ObjLogger(self)
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers))
+        self._futures: Dict[Future, Tuple[ChapterCrawler._GroupState, ApiGetChapters.Results.ChaptersMetadata]] = {}
+        self._comics: Dict[int, ChapterCrawler._ComicState] = {}
+        self._total_update = 0
+        # 取消后 等待API请求数的章节请求立即结束
+        self._cancel = threading.Event()
+
+    def Add(self, comic: CopymangaObject, force=False):
+        # 规划一个漫画的所有分组 章节文件请求立即开始
+        if not force and comic.IsUnchanged():
+            comic.logger.info(f"漫画无更新 [ {comic.comic.datetime_updated} {comic.comic.last_chapter.name} ] 跳过")
+            return
+        for group in comic.groups.values():
+            self.AddGroup(comic, group, force)
+            continue
+        self._Comic(comic).planned = True
+        # 规划下一个漫画前 写入已完成的章节
+        self.Step()
+        return
+
+    def _Comic(self, comic: CopymangaObject) -> "ChapterCrawler._ComicState":
+        state = self._comics.get(id(comic))
+        if state is None:
+            state = ChapterCrawler._ComicState(comic)
+            self._comics[id(comic)] = state
+            comic.cancel = self._cancel
+        return state
+
+    def AddGroup(self, comic: CopymangaObject, group: ApiGetComic.Results.GroupsMetadata, force=False):
+        parent = self._Comic(comic)
+        planned = comic.PlanGroup(group, force)
+        if planned is None:
+            return
+        chapters, total = planned
+        state = ChapterCrawler._GroupState(parent, group, total, len(chapters))
+        if len(chapters) == 0:
+            self._FinishGroup(state)
+            return
+        for chapter in chapters:
+            self._futures[self._executor.submit(comic.GetFiles, chapter)] = (state, chapter)
+            parent.pending += 1
+            continue
+        return
+
+    def _Write(self, future: Future):
+        state, chapter = self._futures.pop(future)
+        comic = state.comic
+        comic.logger.info(f"| + 章节({state.group.name}/{chapter.name})")
+        # 获取或写入失败只影响当前章节 其他漫画继续写入
+        try:
+            files = future.result()
+            if files is None:
+                comic.logger.error(f"|   获取文件失败")
+                state.failed += 1
+            else:
+                state.files += comic.InsertFiles(state.group, chapter, files)
+                state.update += 1
+                state.parent.files += len(files)
+                self._total_update += 1
+        except Exception as e:
+            comic.logger.error(f"|   {chapter.name} {e}")
+            state.failed += 1
+        state.pending -= 1
+        state.parent.pending -= 1
+        if state.pending == 0:
+            self._FinishGroup(state)
+        return
+
+    def _FinishGroup(self, state: "ChapterCrawler._GroupState"):
+        # 保存分组记录失败只影响当前漫画
+        try:
+            state.comic.FinishGroup(state.group, state.total, state.update, state.files, state.failed)
+        except Exception as e:
+            state.comic.logger.error(f"| [ {state.group.name} ] 保存分组记录失败 {e}")
+        return
+
+    def _FinishComics(self, force: bool = False):
+        # 章节全部写入的漫画保存更新记录 force=True 时包括未完成规划的漫画
+        for key, state in list(self._comics.items()):
+            if state.pending != 0 or not (state.planned or force):
+                continue
+            self._comics.pop(key)
+            try:
+                state.comic.FinishUpdate(state.files)
+            except Exception as e:
+                state.comic.logger.error(f"保存更新记录失败 {e}")
+            continue
+        return
+
+    def Step(self):
+        # 写入已完成的章节 不等待
+        for future in [future for future in self._futures if future.done()]:
+            self._Write(future)
+            continue
+        self._FinishComics()
+        return
+
+    def Cancel(self):
+        # 取消未开始的章节请求 等待API请求数的请求立即结束 已获取的章节仍然写入
+        self._cancel.set()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        for future in [future for future in self._futures if future.done() and not future.cancelled() and future.exception() is None]:
+            self._Write(future)
+            continue
+        self._FinishComics()
+        self._futures.clear()
+        self._comics.clear()
+        return
+
+    def Run(self) -> int:
+        # 按完成顺序写入数据库 返回记录的章节数
+        try:
+            for future in as_completed(list(self._futures.keys())):
+                self._Write(future)
+                continue
+            self._FinishComics(force=True)
+        except KeyboardInterrupt:
+            self.Cancel()
+            raise
+        finally:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+        return self._total_update
+
 
 def module_test():
     from main import win32proxy
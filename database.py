@@ -1,5 +1,5 @@
 from pathlib import Path
-from typing import Dict, List, Optional, Sequence, Tuple
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
 
 import sqlalchemy
 from sqlalchemy import Engine, inspect, types, select
@@ -9,6 +9,8 @@ from multipledispatch import dispatch
 import spdlogger
 from uuid import UUID
 import threading
+import time
+from configparser import ConfigParser
 
 uuid0 = UUID("00000000-0000-0000-0000-000000000000")
 
@@ -53,6 +55,7 @@ class Metadata:
 
 class MetadataORM(_ComicTableBase):
     __tablename__ = "metadata"
+    __table_args__ = (sqlalchemy.Index("ix_metadata_tag_name", "tag", "name"),)
     index: Mapped[int] = mapped_column(types.INTEGER, primary_key=True)
     tag: Mapped[str] = mapped_column(types.TEXT)
     name: Mapped[str] = mapped_column(types.TEXT)
@@ -162,6 +165,10 @@ class Chapter:
 
 class ChapterORM(_ComicTableBase):
     __tablename__ = "chapters"
+    __table_args__ = (
+        sqlalchemy.Index("ix_chapters_uuid", "uuid"),
+        sqlalchemy.Index("ix_chapters_group_name", "group", "name"),
+    )
     # 自增索引 API索引   分组名 章节名 文件数 UUID   完成状态   其他状态
     index: Mapped[int] = mapped_column(types.INTEGER, primary_key=True)
     api_index: Mapped[int] = mapped_column(types.INTEGER)
@@ -312,18 +319,26 @@ class File:
 
 class FileORM(_ComicTableBase):
     __tablename__ = "files"
+    __table_args__ = (
+        sqlalchemy.Index("ix_files_group_chapter_page", "group", "chapter", "page"),
+        sqlalchemy.Index("ix_files_dl_status", "dl_status"),
+    )
     # 自增索引 API索引   分组名 章节名 页号 扩展名  储存位置 下载地址   跳过状态 下载状态   其他状态
     index: Mapped[int] = mapped_column(types.INTEGER, primary_key=True)
     api_index: Mapped[int] = mapped_column(types.INTEGER)
     group: Mapped[str] = mapped_column(types.TEXT)
     chapter: Mapped[str] = mapped_column(types.TEXT)
-    page: Mapped[int] = mapped_column(types.TEXT)
+    page: Mapped[int] = mapped_column(types.INTEGER)
     extension: Mapped[str] = mapped_column(types.TEXT)
     dl_path: Mapped[str] = mapped_column(types.TEXT)
     dl_url: Mapped[str] = mapped_column(types.TEXT)
     dl_skip: Mapped[bool] = mapped_column(types.BOOLEAN)
     dl_status: Mapped[int] = mapped_column(types.INTEGER)
     status: Mapped[int] = mapped_column(types.INTEGER)
+    # 下载完成时记录 文件大小 哈希 修改时间(ns) 用于校验
+    size: Mapped[int] = mapped_column(types.INTEGER, default=-1, server_default=sqlalchemy.text("-1"))
+    hash: Mapped[str] = mapped_column(types.TEXT, default="", server_default="")
+    mtime: Mapped[int] = mapped_column(types.INTEGER, default=-1, server_default=sqlalchemy.text("-1"))
 
     def __str__(self) -> str:
         return f"<{self.__tablename__} [{self.index}]{
@@ -389,10 +404,28 @@ class FileORM(_ComicTableBase):
             self.dl_skip = struct.dl_skip
         if struct.dl_status is not None:
             self.dl_status = struct.dl_status
+            if struct.dl_status in FILE_REDOWNLOAD_STATUS:
+                self.size, self.hash, self.mtime = -1, "", -1
         if struct.status is not None:
             self.status = struct.status
         return
 
+    def Struct(self) -> File:
+        # 脱离 Session 的快照 可在其他线程中使用
+        return File(
+            api_index=self.api_index,
+            group=self.group,
+            chapter=self.chapter,
+            page=self.page,
+            extension=self.extension,
+            dl_path=self.dl_path,
+            dl_url=self.dl_url,
+            dl_skip=self.dl_skip,
+            dl_status=self.dl_status,
+            status=self.status,
+            index=self.index,
+        )
+
     @staticmethod
     def From(struct: FileOptional | File):
         return FileORM.Create(
@@ -436,19 +469,227 @@ class FileORM(_ComicTableBase):
         return query
 
 
+#
+#
+#
+
+
+def _TableColumns(conn: sqlalchemy.Connection, table: str) -> Dict[str, str]:
+    rows = conn.exec_driver_sql(f'PRAGMA table_info("{table}")').all()
+    return {row[1]: str(row[2]).upper() for row in rows}
+
+
+def _Migrate_FilePageInteger(conn: sqlalchemy.Connection):
+    # files.page 由 TEXT 重建为 INTEGER
+    columns = _TableColumns(conn, FileORM.__tablename__)
+    if columns.get("page") == "INTEGER":
+        return
+    conn.exec_driver_sql(f'ALTER TABLE "{FileORM.__tablename__}" RENAME TO "_files_migrate"')
+    FileORM.__table__.create(conn)
+    names = [name for name in FileORM.__table__.columns.keys() if name in columns]
+    target = ", ".join(f'"{name}"' for name in names)
+    source = ", ".join('CAST("page" AS INTEGER)' if name == "page" else f'"{name}"' for name in names)
+    conn.exec_driver_sql(f'INSERT INTO "{FileORM.__tablename__}" ({target}) SELECT {source} FROM "_files_migrate"')
+    conn.exec_driver_sql('DROP TABLE "_files_migrate"')
+    return
+
+
+def _Migrate_CreateIndexes(conn: sqlalchemy.Connection):
+    for orm in (MetadataORM, ChapterORM, FileORM):
+        for index in orm.__table__.indexes:
+            index.create(conn, checkfirst=True)
+    return
+
+
+def _Migrate_FileManifest(conn: sqlalchemy.Connection):
+    # files 增加 size/hash/mtime 新建的数据库已包含
+    columns = _TableColumns(conn, "files")
+    for name, define in (
+        ("size", "INTEGER NOT NULL DEFAULT -1"),
+        ("hash", "TEXT NOT NULL DEFAULT ''"),
+        ("mtime", "INTEGER NOT NULL DEFAULT -1"),
+    ):
+        if name not in columns:
+            conn.exec_driver_sql(f'ALTER TABLE "files" ADD COLUMN "{name}" {define}')
+    return
+
+
+# 数据库结构版本 (PRAGMA user_version) -> 迁移函数
+_MIGRATIONS: List[Tuple[int, Callable[[sqlalchemy.Connection], None]]] = [
+    (1, _Migrate_FilePageInteger),
+    (2, _Migrate_CreateIndexes),
+    (3, _Migrate_FileManifest),
+]
+
+
+class EngineProfile:
+    _INI_ENGINE = "Engine"
+
+    def __init__(
+        self,
+        journal_mode: Optional[str] = "WAL",
+        synchronous: Optional[str] = "NORMAL",
+        cache_size: Optional[int] = -32768,
+        mmap_size: Optional[int] = 268435456,
+        temp_store: Optional[str] = "MEMORY",
+        busy_timeout: Optional[int] = 10000,
+    ) -> None:
+        # 值为 None 时保持 SQLite 默认设置
+        # cache_size 为负数时单位为 KiB
+        self.journal_mode = journal_mode
+        self.synchronous = synchronous
+        self.cache_size = cache_size
+        self.mmap_size = mmap_size
+        self.temp_store = temp_store
+        self.busy_timeout = busy_timeout
+
+    def __str__(self) -> str:
+        return f"<{EngineProfile.__name__} {'; '.join(self.Pragmas())} />"
+
+    def Pragmas(self) -> List[str]:
+        pragmas: List[str] = []
+        for name in ("journal_mode", "synchronous", "cache_size", "mmap_size", "temp_store", "busy_timeout"):
+            value = getattr(self, name)
+            if value is None:
+                continue
+            pragmas.append(f"PRAGMA {name} = {value}")
+        return pragmas
+
+    def Apply(self, dbapi_connection, connection_record=None):
+        cursor = dbapi_connection.cursor()
+        for pragma in self.Pragmas():
+            cursor.execute(pragma)
+        cursor.close()
+        return
+
+    @staticmethod
+    def Default():
+        return EngineProfile()
+
+    @staticmethod
+    def Legacy():
+        return EngineProfile(None, None, None, None, None, None)
+
+    @staticmethod
+    def Load(filepath: Path):
+        # 部署配置 [Engine] 节 未设置的项使用默认值 值为空时保持SQLite默认设置
+        profile = EngineProfile.Default()
+        if not filepath.exists():
+            return profile
+        conf = ConfigParser()
+        conf.read(filepath.as_posix(), encoding="utf-8")
+        if not conf.has_section(EngineProfile._INI_ENGINE):
+            return profile
+        for name in ("journal_mode", "synchronous", "temp_store"):
+            if conf.has_option(EngineProfile._INI_ENGINE, name):
+                value = conf.get(EngineProfile._INI_ENGINE, name).strip()
+                setattr(profile, name, value if len(value) != 0 else None)
+        for name in ("cache_size", "mmap_size", "busy_timeout"):
+            if conf.has_option(EngineProfile._INI_ENGINE, name):
+                value = conf.get(EngineProfile._INI_ENGINE, name).strip()
+                setattr(profile, name, int(value, 10) if len(value) != 0 else None)
+        return profile
+
+
+globle_engine_profile = EngineProfile.Default()
+
+
+# 需要重新下载的状态 同时清除下载完成时记录的 大小 哈希 修改时间
+FILE_REDOWNLOAD_STATUS = (File.DlStatus.Wait, File.DlStatus.Update)
+FILE_MANIFEST_CLEAR: Dict[str, Any] = {"size": -1, "hash": "", "mtime": -1}
+
+
+def _UpdateRows(session: Session, rows: Sequence[Dict[str, Any]]):
+    # 按主键批量 UPDATE 按修改的列分组 每组一次 executemany
+    groups: Dict[Tuple[str, ...], List[Dict[str, Any]]] = {}
+    for row in rows:
+        groups.setdefault(tuple(sorted(row)), []).append(row)
+    for group in groups.values():
+        session.execute(sqlalchemy.update(FileORM), group)
+    return
+
+
+class StatusJournal:
+    # 延迟写入文件状态 合并同一文件的多次变化 按数量或时间批量 UPDATE
+    # 未写入的状态在崩溃后丢失 文件保持 Wait/Active 由下载流程重新下载
+    def __init__(self, session: Session, flush_count: int = 64, flush_interval: float = 0.5) -> None:
+        self._session = session
+        self._pending: Dict[int, Dict[str, Any]] = {}
+        self._first_time: Optional[float] = None
+        self.flush_count = flush_count
+        self.flush_interval = flush_interval
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def Set(self, index: int, **columns: Any):
+        self._pending.setdefault(index, {}).update(columns)
+        if self._first_time is None:
+            self._first_time = time.monotonic()
+        if len(self._pending) >= self.flush_count:
+            self.Flush()
+        return
+
+    def Get(self, index: int) -> Optional[Dict[str, Any]]:
+        return self._pending.get(index)
+
+    def Tick(self):
+        # 由调用方循环定期调用 超过时间时写入
+        if self._first_time is not None and time.monotonic() - self._first_time >= self.flush_interval:
+            self.Flush()
+        return
+
+    def Flush(self) -> int:
+        if len(self._pending) == 0:
+            return 0
+        try:
+            _UpdateRows(self._session, [{"index": index, **columns} for index, columns in self._pending.items()])
+            self._session.commit()
+        except Exception:
+            self._session.rollback()
+            raise
+        count = len(self._pending)
+        self._pending.clear()
+        self._first_time = None
+        return count
+
+
+class UpsertPagesResult:
+    def __init__(self) -> None:
+        self.chapter: int = -1
+        self.added: Dict[int, FileORM | int] = {}
+        self.updated: Dict[int, FileORM | int] = {}
+        self.skipped: Dict[int, FileORM | int] = {}
+
+    def Collect(self, orm_chapter: ChapterORM):
+        # 页号 -> 文件索引
+        self.chapter = orm_chapter.index
+        for items in (self.added, self.updated, self.skipped):
+            for page, item in items.items():
+                items[page] = item.index if isinstance(item, FileORM) else item
+        return
+
+    def __len__(self) -> int:
+        return len(self.added) + len(self.updated) + len(self.skipped)
+
+
 class ComicDatabase:
-    def __init__(self, filepath: Path):
+    def __init__(self, filepath: Path, profile: Optional[EngineProfile] = None):
         self._logger = logger.ObjLogger(self)
         self._filepath: Path = filepath
         self._filepath.resolve().parent.mkdir(parents=True, exist_ok=True)
+        self.profile = globle_engine_profile if profile is None else profile
         self.engine: sqlalchemy.Engine = sqlalchemy.create_engine(
             f"sqlite:///{self._filepath.as_posix()}",
         )
+        sqlalchemy.event.listen(self.engine, "connect", self.profile.Apply)
 
         _ComicTableBase.metadata.create_all(self.engine)
+        self._Migrate()
 
         self.lock = threading.Lock()
         self.session = Session(self.engine)
+        self.journal = StatusJournal(self.session)
 
         self.attribute = ComicDatabase._Attribute(self.session)
         self.group = ComicDatabase._Group(self.session)
@@ -457,6 +698,19 @@ class ComicDatabase:
 
         return
 
+    def _Migrate(self):
+        with self.engine.begin() as conn:
+            version: int = conn.exec_driver_sql("PRAGMA user_version").scalar_one()
+            for target, migrate in _MIGRATIONS:
+                if version >= target:
+                    continue
+                self._logger.info(f'迁移数据库 v{version} -> v{target} "{self._filepath.as_posix()}"')
+                migrate(conn)
+                conn.exec_driver_sql(f"PRAGMA user_version = {target}")
+                version = target
+                continue
+        return
+
     def Delete(self, obj: FileORM | ChapterORM | MetadataORM):
         self.session.delete(obj)
         self.session.commit()
@@ -464,12 +718,39 @@ class ComicDatabase:
     def Commit(self):
         self.session.commit()
 
+    def SelectFilePage(self, dl_status: int, after: int, limit: int) -> List[File]:
+        # 按 index 分页 (ix_files_dl_status 隐含 rowid 可直接定位)
+        # 使用独立的 Session 可在其他线程中调用
+        with Session(self.engine) as session:
+            items = (
+                FileORM.MakeQuery(session, FileOptional(dl_status=dl_status))
+                .filter(FileORM.index > after)
+                .order_by(FileORM.index)
+                .limit(limit)
+                .all()
+            )
+            return [item.Struct() for item in items]
+
     def GetDatabaseFilePath(self) -> Path:
         return self._filepath.resolve()
 
+    def GetDatabaseFiles(self) -> List[Path]:
+        # WAL 模式下的附属文件
+        path = self.GetDatabaseFilePath()
+        return [path, Path(f"{path.as_posix()}-wal"), Path(f"{path.as_posix()}-shm")]
+
+    def Flush(self):
+        return self.journal.Flush()
+
+    def Close(self):
+        self.journal.Flush()
+        self.session.close()
+        self.engine.dispose()
+
     class _Attribute:
         #
         METADATA_NAME_TAG = "__name__"
+        METADATA_UPDATED_TAG = "__updated__"
 
         def __init__(self, session: Session) -> None:
             self.session = session
@@ -530,9 +811,23 @@ class ComicDatabase:
         def SetPathword(self, pathword: str):
             return self.ForceTagSet(self.METADATA_NAME_TAG, MetadataOptional(value=pathword))
 
+        def GetUpdated(self) -> Optional[Tuple[str, str]]:
+            # 上次完整更新时的 (datetime_updated, last_chapter.uuid)
+            item = self.SelectTag(self.METADATA_UPDATED_TAG)
+            if item is None:
+                return None
+            return item.name, item.value
+
+        def SetUpdated(self, datetime_updated: str, last_chapter: str):
+            struct = MetadataOptional(name=datetime_updated, value=last_chapter)
+            if self.SelectTag(self.METADATA_UPDATED_TAG) is None:
+                return self.AddTag(self.METADATA_UPDATED_TAG, struct)
+            return self.ForceTagSet(self.METADATA_UPDATED_TAG, struct)
+
     class _Group:
         #
         METADATA_GROUP_TAG = "__group__"
+        METADATA_GROUP_COUNT_TAG = "__group_count__"
 
         def __init__(self, session: Session) -> None:
             self.session = session
@@ -582,6 +877,25 @@ class ComicDatabase:
             self.session.commit()
             return item
 
+        # ================================================================================================
+
+        def GetCount(self, name: str) -> Optional[int]:
+            # 上次完整更新时的分组章节数
+            item = MetadataORM.MakeQuery(self.session, MetadataOptional(tag=self.METADATA_GROUP_COUNT_TAG, name=name)).first()
+            if item is None:
+                return None
+            return int(item.value, 10)
+
+        def SetCount(self, name: str, count: int):
+            item = MetadataORM.MakeQuery(self.session, MetadataOptional(tag=self.METADATA_GROUP_COUNT_TAG, name=name)).first()
+            if item is None:
+                item = MetadataORM.Create(tag=self.METADATA_GROUP_COUNT_TAG, name=name, value=str(count))
+                self.session.add(item)
+            else:
+                item.value = str(count)
+            self.session.commit()
+            return item
+
     class _Chapter:
         #
         def __init__(self, session: Session) -> None:
@@ -621,6 +935,21 @@ class ComicDatabase:
         def ForceGroupGet(self, group: str):
             return self.GetAll(ChapterOptional(group=group))
 
+        def CountGroup(self, group: str) -> int:
+            return ChapterORM.MakeQuery(self.session, ChapterOptional(group=group)).count()
+
+        def GetGroupIndexRows(self, group: str):
+            # 分组内已记录章节的 (api_index, uuid) 按 api_index 排序
+            return (
+                ChapterORM.MakeQuery(self.session, ChapterOptional(group=group))
+                .with_entities(
+                    ChapterORM.api_index,
+                    ChapterORM.uuid,
+                )
+                .order_by(ChapterORM.api_index)
+                .all()
+            )
+
         def ForceNameGet(self, group: str, name: str):
             return self.GetOne(ChapterOptional(group=group, name=name))
 
@@ -672,6 +1001,65 @@ class ComicDatabase:
         def GetOne(self, struct: FileOptional):
             return FileORM.MakeQuery(self.session, struct).one()
 
+        def Count(self, struct: FileOptional):
+            return FileORM.MakeQuery(self.session, struct).count()
+
+        def GetPathRows(self, struct: FileOptional):
+            # 只读取生成文件路径需要的列 不创建 ORM 对象
+            return (
+                FileORM.MakeQuery(self.session, struct)
+                .with_entities(
+                    FileORM.index,
+                    FileORM.api_index,
+                    FileORM.group,
+                    FileORM.chapter,
+                    FileORM.page,
+                    FileORM.extension,
+                    FileORM.dl_skip,
+                    FileORM.dl_status,
+                    FileORM.size,
+                    FileORM.hash,
+                    FileORM.mtime,
+                )
+                .all()
+            )
+
+        def UpdateRows(self, rows: Sequence[Dict[str, Any]]):
+            # rows 为包含 index 的列字典 在一个事务中提交
+            try:
+                _UpdateRows(self.session, rows)
+                self.session.commit()
+            except Exception:
+                self.session.rollback()
+                raise
+            return len(rows)
+
+        def UpdateIndexes(self, indexes: Sequence[int], struct: FileOptional, commit: bool = True):
+            # 批量修改 commit=False 时由调用方在同一事务中提交
+            values = {}
+            for name in ("api_index", "group", "chapter", "page", "extension", "dl_path", "dl_url", "dl_skip", "dl_status", "status"):
+                value = getattr(struct, name)
+                if value is not None:
+                    values[name] = value
+            if len(values) == 0:
+                return 0
+            if values.get("dl_status") in FILE_REDOWNLOAD_STATUS:
+                values.update(FILE_MANIFEST_CLEAR)
+            try:
+                for i in range(0, len(indexes), 500):
+                    self.session.execute(
+                        sqlalchemy.update(FileORM)
+                        .where(FileORM.index.in_(indexes[i : i + 500]))
+                        .values(**values)
+                        .execution_options(synchronize_session=False)
+                    )
+                if commit:
+                    self.session.commit()
+            except Exception:
+                self.session.rollback()
+                raise
+            return len(indexes)
+
         # ================================================================================================
 
         def SelectPage(self, group: str, chapter: str, page: int):
@@ -718,6 +1106,64 @@ class ComicDatabase:
             self.session.commit()
             return item
 
+        def UpsertPages(self, group: str, chapter: str, pages: Dict[int, FileOptional], struct: ChapterOptional):
+            # 一次读取章节已有文件 在内存中比较后 单个事务写入文件和章节
+            result = UpsertPagesResult()
+
+            exists: Dict[int, FileORM] = {}
+            for item in self.ForceChapterGet(group, chapter):
+                exists[int(item.page)] = item
+
+            for page, page_struct in pages.items():
+                item = exists.get(page)
+
+                # 文件 新增
+                if item is None:
+                    page_struct.group = group
+                    page_struct.chapter = chapter
+                    page_struct.page = page
+                    item = FileORM.From(page_struct)
+                    self.session.add(item)
+                    result.added[page] = item
+                    continue
+
+                # 文件 跳过更新
+                if item.dl_skip:
+                    result.skipped[page] = item
+                    continue
+
+                # 文件 更新URL
+                item.Set(
+                    FileOptional(
+                        extension=page_struct.extension,
+                        dl_url=page_struct.dl_url,
+                        dl_status=File.DlStatus.Update,
+                    )
+                )
+                result.updated[page] = item
+                continue
+
+            # 章节 新增或更新
+            orm_chapter = ChapterORM.MakeQuery(self.session, ChapterOptional(group=group, name=chapter)).first()
+            struct.group = group
+            struct.name = chapter
+            if orm_chapter is None:
+                orm_chapter = ChapterORM.From(struct)
+                self.session.add(orm_chapter)
+            else:
+                orm_chapter.Set(struct)
+
+            # 提交前读取索引 避免提交后逐行刷新
+            try:
+                self.session.flush()
+                result.Collect(orm_chapter)
+                self.session.commit()
+            except Exception:
+                self.session.rollback()
+                raise
+
+            return result
+
         # ================================================================================================
 
         def Set_DlStatus_Wait(self, index: int):
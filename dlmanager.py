@@ -1,12 +1,17 @@
 import datetime
 import threading
+import queue
 
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
 import time
-from typing import List, Optional, Sequence, Tuple
+from typing import Callable, Deque, Dict, List, Optional, Sequence, Set, Tuple
 
 import database
 import aria2tool
+import ratelimit
+import scanner
 
 import spdlogger
 
@@ -26,52 +31,176 @@ def ClearDir(path: Path) -> int:
     return remove_count
 
 
-class RequsetCountLock:
-    def __init__(self, num: int) -> None:
-        self._queue: List[datetime.datetime] = []
-        self._lock = threading.Lock()
-        self._num = num
+globle_max_download_request_num = 99
+globle_download_request_lock = ratelimit.globle_rate_limiters.Get("download", globle_max_download_request_num)
 
-    def ReleaseTime(self):
-        if len(self._queue) == 0:
-            return 0
-        return (self._queue[0] - datetime.datetime.now()).seconds
 
-    def Ready(self):
-        self._lock.acquire()
-        ret = True
-        while len(self._queue) >= self._num:
-            if self._queue[0] > datetime.datetime.now():
-                ret = False
-                break
-            self._queue.pop(0)
-            ret = True
-            break
-        self._lock.release()
-        return ret
-
-    def CountAdd(self):
-        self._lock.acquire()
-        self._queue.append(datetime.datetime.now() + datetime.timedelta(seconds=61))
-        self._lock.release()
-
-    def Refresh(self):
-        self._lock.acquire()
-        while len(self._queue) != 0:
-            if self._queue[0] > datetime.datetime.now():
+def SaveSession(aria2_client: aria2tool.Aria2Client):
+    # 退出前保存下载服务的未完成任务
+    try:
+        return aria2_client.SaveSession()
+    except Exception as e:
+        logger.error(f"保存下载会话失败: {e}")
+        return False
+
+
+class FileQueue:
+    def __init__(self, wakeup: Optional[threading.Event] = None) -> None:
+        # 更新线程写入新记录的文件索引 下载线程读取
+        self._queue: "queue.Queue[int | None]" = queue.Queue()
+        self._wakeup = wakeup
+        self.closed = False
+
+    def Put(self, index: int):
+        self._queue.put(index)
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return
+
+    def Close(self):
+        # 更新结束 不再有新文件
+        self._queue.put(None)
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return
+
+    def Drain(self, indexes: List[int]) -> bool:
+        while True:
+            try:
+                index = self._queue.get_nowait()
+            except queue.Empty:
                 break
-            self._queue.pop(0)
+            if index is None:
+                self.closed = True
+                continue
+            indexes.append(index)
             continue
-        self._lock.release()
+        return self.closed
+
+
+class PendingFileQueue:
+    # 按 index 分页读取待下载文件 后台预读下一页 添加任务时从内存中取出
+    def __init__(self, db: database.ComicDatabase, dl_status: int, page_size: int = 256) -> None:
+        # 后台线程只读取已写入的状态
+        db.Flush()
+        self._database = db
+        self._dl_status = dl_status
+        self._page_size = page_size
+        self._files: Deque[database.File] = deque()
+        self._after = 0
+        self._exhausted = False
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._future: Optional[Future] = None
+
+    def __len__(self) -> int:
+        return len(self._files)
+
+    def _Fetch(self, after: int):
+        return self._database.SelectFilePage(self._dl_status, after, self._page_size)
+
+    def _Extend(self, files: List[database.File]):
+        if len(files) < self._page_size:
+            self._exhausted = True
+        if len(files) != 0:
+            self._after = files[-1].index
+        self._files.extend(files)
+        return
+
+    def _Prefetch(self):
+        # 剩余不足半页时 后台读取下一页
+        if self._exhausted or self._future is not None:
+            return
+        if len(self._files) > self._page_size // 2:
+            return
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1)
+        self._future = self._executor.submit(self._Fetch, self._after)
         return
 
+    def Peek(self) -> Optional[database.File]:
+        if len(self._files) == 0:
+            if self._future is not None:
+                future, self._future = self._future, None
+                self._Extend(future.result())
+            elif not self._exhausted:
+                self._Extend(self._Fetch(self._after))
+        if len(self._files) == 0:
+            return None
+        self._Prefetch()
+        return self._files[0]
+
+    def Pop(self) -> database.File:
+        file = self._files.popleft()
+        self._Prefetch()
+        return file
+
+    def Close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        self._future = None
+        return
+
+
+class ConcurrencyController:
+    # AIMD 根据下载速度/错误数/剩余请求数调整同时下载的任务数
+    def __init__(self, window: int = 8, min_window: int = 2, max_window: int = 64) -> None:
+        self.window = float(window)
+        self.min_window = min_window
+        self.max_window = max_window
+        self.lock = globle_download_request_lock
+
+        # 增加间隔 避免通知唤醒时连续增加
+        self.increase_interval = 1.0
+        # 减少冷却 一次错误风暴只减半一次
+        self.decrease_cooldown = 5.0
+        # 速度低于上次的比例时认为链路已饱和
+        self.saturate_ratio = 0.9
+
+        self.errors = 0
+        self.last_speed = 0
+        self.increase_time = 0.0
+        self.decrease_time = 0.0
+
     def __str__(self) -> str:
-        self.Refresh()
-        return f"{len(self._queue)}/{self._num}"
+        return f"{self.Window()}"
 
+    def Window(self) -> int:
+        return int(self.window)
 
-globle_max_download_request_num = 99
-globle_download_request_lock = RequsetCountLock(globle_max_download_request_num)
+    def OnError(self):
+        self.errors += 1
+        return
+
+    def Update(self, speed: int, active_num: int) -> int:
+        now = time.monotonic()
+        errors, self.errors = self.errors, 0
+        last_speed, self.last_speed = self.last_speed, speed
+
+        # 出现错误 乘性减少
+        if errors != 0:
+            if now - self.decrease_time >= self.decrease_cooldown:
+                self.window = max(float(self.min_window), self.window / 2)
+                self.decrease_time = now
+            return self.Window()
+
+        # 任务数未用满 瓶颈不在任务数
+        if active_num < self.Window():
+            return self.Window()
+
+        # 增加任务后速度下降 链路已饱和
+        if speed < last_speed * self.saturate_ratio:
+            return self.Window()
+
+        # 剩余请求数不足 增加任务只会等待请求数
+        if self.lock.Remaining() < self.Window():
+            return self.Window()
+
+        # 加性增加
+        if now - self.increase_time >= self.increase_interval:
+            self.window = min(float(self.max_window), self.window + 1)
+            self.increase_time = now
+        return self.Window()
 
 
 class Task:
@@ -100,6 +229,10 @@ class Task:
         self.filepath = Path()
         self.download_dir = Path(download_dir)
         self.temp_dir = Path(temp_dir)
+        # 保存后的 大小 修改时间 哈希
+        self.manifest: Optional[Tuple[int, int, str]] = None
+        # 断点续传 保留缓存文件由下载服务继续下载
+        self.keep_temp = False
 
         self.logger = logger.ObjLogger(self)
         return
@@ -113,7 +246,7 @@ class Task:
     def GetTempFullPath(self):
         return self.temp_dir / self.filepath
 
-    def LoadOrmFile(self, obj: database.FileORM):
+    def LoadOrmFile(self, obj: database.FileORM | database.File):
         if self.gid is not None:
             self.Stop()
 
@@ -143,7 +276,9 @@ class Task:
             if checkfile.is_dir():
                 self.logger.error(f'缓存文件路径 "{checkfile.as_posix()}" 被目录占用')
                 return Task.LOAD_Error_PathProblem
-            if checkfile.is_file():
+            if checkfile.is_file() and self.keep_temp:
+                self.logger.debug(f'继续缓存 "{checkfile.as_posix()}"')
+            elif checkfile.is_file():
                 self.logger.debug(f'删除缓存 "{checkfile.as_posix()}"')
                 checkfile.unlink()
             pass
@@ -181,8 +316,9 @@ class Task:
         self.logger.debug(f'提交 {self.gid} -> "{cahce.as_posix()}"')
         return True
 
-    def Save(self) -> bool:
-        status = self.Status()
+    def Save(self, status: aria2tool.RpcStructStatus | None = None) -> bool:
+        if status is None:
+            status = self.Status()
         if status is None:
             return False
         if status.status != "complete":
@@ -193,6 +329,7 @@ class Task:
         # 移动缓存文件
         file = self.GetTempFullPath()
         file.rename(save)
+        self.manifest = scanner.FileManifest(save)
         self.logger.info(f'完成 {self.gid} -> "{save.as_posix()}"')
         return True
 
@@ -207,16 +344,23 @@ class CopymangaDLManger:
         proxy: Optional[str],
         download_dir: Path,
         temp_dir: Path,
+        notifier: Optional[aria2tool.Aria2Notifier] = None,
+        resume: bool = False,
     ) -> None:
         self.logger = logger.ObjLogger(self)
         self.proxy = proxy
+        self.resume = resume
 
-        self.max_task_num = 20
+        self.controller = ConcurrencyController()
+        self.max_task_num = self.controller.Window()
         self.active_tasks: List[Task] = []
         self.lock = globle_download_request_lock
 
         self.aria2_client = aria2_client
         self.database = sql_client
+        self.aria2_window: Optional[int] = None
+        # 按下载状态缓存的待下载文件
+        self.pending: Dict[int, PendingFileQueue] = {}
 
         self.thread_exit: bool = False
 
@@ -231,23 +375,58 @@ class CopymangaDLManger:
 
         self.temp_dir.mkdir(parents=True, exist_ok=True)
         self.download_dir.mkdir(parents=True, exist_ok=True)
-        ClearDir(self.temp_dir)
+        if not self.resume:
+            ClearDir(self.temp_dir)
 
         self.is_throttled = False
         self.is_finished = False
+
+        # 调度器模式 当前检查的文件状态
+        self.step_stage = 0
+        self.step_files: Optional[List[database.FileORM]] = None
+
+        # 下载完成/错误通知 唤醒下载循环
+        self.wakeup = threading.Event()
+        self.notifier = notifier
+        self.notify_interval = 5.0
+        if self.notifier is not None:
+            self.notifier.Subscribe(self.OnNotify)
+        return
+
+    def OnNotify(self, method: str, gid: str):
+        if method in (aria2tool.Aria2Notifier.ON_COMPLETE, aria2tool.Aria2Notifier.ON_ERROR, aria2tool.Aria2Notifier.ON_STOP):
+            self.wakeup.set()
         return
 
-    def TaskCompleted(self, task: Task):
-        if not task.Save():
+    def Close(self):
+        for pending in self.pending.values():
+            pending.Close()
+        self.pending.clear()
+        self.database.Flush()
+        if self.resume:
+            SaveSession(self.aria2_client)
+        if self.notifier is not None:
+            self.notifier.Unsubscribe(self.OnNotify)
+        return
+
+    def TaskCompleted(self, task: Task, status: aria2tool.RpcStructStatus | None = None):
+        if not task.Save(status):
             self.logger.error(f"{task} 无法移动缓存")
             return False
-        self.database.file.Set_DlStatus_Completed(task.orm_bind)
+        if task.manifest is None:
+            self.database.journal.Set(task.orm_bind, dl_status=database.File.DlStatus.Completed)
+            return True
+        size, mtime, digest = task.manifest
+        self.database.journal.Set(task.orm_bind, dl_status=database.File.DlStatus.Completed, size=size, mtime=mtime, hash=digest)
         return True
 
     def TaskTryfix(self, task: Task):
-        task.Stop()
+        # 出错的任务在下载服务中已经停止 下载结果由调用者清除
+        self.controller.OnError()
+        task.gid = None
         if task.err_cnt >= 5:
-            self.logger.error(f"{task} 失败")
+            self.logger.error(f"{task} 失败 标记为下载错误")
+            self.database.journal.Set(task.orm_bind, dl_status=database.File.DlStatus.Error)
             return False
         else:
             task.err_cnt += 1
@@ -260,39 +439,120 @@ class CopymangaDLManger:
     def ActiveQueueZero(self):
         return len(self.active_tasks) == 0
 
-    def CreateTask(self, file: database.FileORM):
-        # 新建下载任务
+    def ApplyWindow(self, window: int):
+        # 同步下载服务的同时下载数 超出的任务在下载服务中排队
+        if window != self.max_task_num:
+            self.logger.debug(f"任务数 {self.max_task_num} -> {window}")
+        self.max_task_num = window
+        if window != self.aria2_window:
+            self.aria2_client.ChangeGlobalOption({"max-concurrent-downloads": str(window)})
+            self.aria2_window = window
+        return
+
+    def SetFileStatus(self, file: database.FileORM | database.File, dl_status: int, dl_skip: Optional[bool] = None):
+        # 延迟写入 ORM 对象不修改 避免长时间持有写事务
+        if isinstance(file, database.File):
+            file.dl_status = dl_status
+        if dl_skip is None:
+            self.database.journal.Set(file.index, dl_status=dl_status)
+        else:
+            self.database.journal.Set(file.index, dl_status=dl_status, dl_skip=dl_skip)
+        return
+
+    def MakeTask(self):
         task = Task(
             self.aria2_client,
             self.download_dir,
             self.temp_dir,
         )
+        task.keep_temp = self.resume
+        return task
+
+    def ResumeTasks(self) -> List[database.FileORM]:
+        # 断点续传 按缓存路径找回下载服务恢复的任务 返回未找回的文件
+        self.database.Flush()
+        files = self.database.file.GetAll(
+            database.FileOptional(dl_status=database.File.DlStatus.Active),
+        )
+        if len(files) == 0:
+            return files
+
+        paths = self.aria2_client.TellPaths()
+        remain: List[database.FileORM] = []
+        gids: List[str] = []
+        for file in files:
+            task = self.MakeTask()
+            if task.LoadOrmFile(file) != Task.LOAD_Succ_WaitSmbmit:
+                remain.append(file)
+                continue
+            gid = paths.get(task.GetTempFullPath().resolve().as_posix())
+            if gid is None:
+                remain.append(file)
+                continue
+            task.gid = gid
+            task.orm_bind = file.index
+            gids.append(gid)
+            self.lock.Add()
+            self.active_tasks.append(task)
+            self.logger.info(f'恢复 {gid} -> "{task.GetTempFullPath().as_posix()}"')
+            continue
+
+        # 调度器模式下恢复的任务已暂停 找回后继续下载 未暂停的任务返回失败 忽略
+        if len(gids) != 0:
+            self.aria2_client.UnpauseMany(gids)
+        self.logger.info(f"恢复 {len(files) - len(remain)} 个任务 重新下载 {len(remain)} 个文件")
+        return remain
+
+    def CreateTask(self, file: database.FileORM | database.File):
+        # 新建下载任务
+        task = self.MakeTask()
 
         status = task.LoadOrmFile(file)
         # 开始下载 标记到数据库
         if status == Task.LOAD_Succ_WaitSmbmit:
-            file.dl_status = database.File.DlStatus.Active
-            self.database.Commit()
+            self.SetFileStatus(file, database.File.DlStatus.Active)
             task.orm_bind = file.index
             task.Start()
-            self.lock.CountAdd()
             self.active_tasks.append(task)
             return True
         # 非法URL 标记到数据库
         elif status == Task.LOAD_Error_InvalidUrl:
-            file.dl_status = database.File.DlStatus.InvalidUrl
-            file.dl_skip = True
-            self.database.Commit()
+            self.SetFileStatus(file, database.File.DlStatus.InvalidUrl, True)
             return False
         # 路径故障 标记到数据库
         elif status == Task.LOAD_Error_PathProblem:
-            file.dl_status = database.File.DlStatus.Error
-            self.database.Commit()
+            self.SetFileStatus(file, database.File.DlStatus.Error)
         else:
             raise ValueError(f"task: load orm return status {status}")
         self.logger.error(f"创建任务失败 {task} ")
         return False
 
+    def TryAcquire(self) -> bool:
+        if not self.lock.TryAcquire():
+            if self.is_throttled is False:
+                self.logger.debug(f"等待DL请求数 {self.lock.ReleaseTime():.1f}s")
+            self.is_throttled = True
+            return False
+        self.is_throttled = False
+        return True
+
+    def Wait(self):
+        self.database.journal.Tick()
+        release_time = self.lock.ReleaseTime() if self.is_throttled else 0.0
+        # 受限且无活动任务时 直接等待到下一个可用请求
+        if release_time > 0 and self.ActiveQueueZero():
+            self.lock.WaitReady()
+            return
+        # 等待任务状态更新 有通知时立即继续 受限时在有可用请求后立即继续
+        wait = 1.0
+        if self.notifier is not None and self.notifier.isConnected():
+            wait = self.notify_interval
+        if release_time > 0:
+            wait = min(wait, release_time)
+        self.wakeup.wait(wait)
+        self.wakeup.clear()
+        return
+
     def AddFiles(self, files: List[database.FileORM]):
         if self.ActiveQueueFull():
             return False
@@ -300,17 +560,14 @@ class CopymangaDLManger:
         if len(files) == 0:
             return None
 
-        if not self.lock.Ready():
-            sec = self.lock.ReleaseTime()
-            if self.is_throttled is False and sec != 0:
-                self.logger.debug(f"等待DL请求数 {self.lock.ReleaseTime()}s")
-            self.is_throttled = True
+        if not self.TryAcquire():
             return False
 
-        self.is_throttled = False
         file = files.pop(0)
 
         status = self.CreateTask(file)
+        if not status:
+            self.lock.Refund()
 
         return status
 
@@ -318,33 +575,73 @@ class CopymangaDLManger:
         if self.ActiveQueueFull():
             return False
 
-        file = self.database.file.GetFirst(
-            database.FileOptional(dl_status=dl_status),
-        )
+        pending = self.pending.get(dl_status)
+        if pending is None:
+            pending = PendingFileQueue(self.database, dl_status)
+            self.pending[dl_status] = pending
+
+        file = pending.Peek()
 
         if file is None:
+            pending.Close()
+            self.pending.pop(dl_status)
             return None
 
         # 限制API请求次数
-        if not self.lock.Ready():
-            sec = self.lock.ReleaseTime()
-            if self.is_throttled is False and sec != 0:
-                self.logger.debug(f"等待DL请求数 {self.lock.ReleaseTime()}s")
-            self.is_throttled = True
+        if not self.TryAcquire():
             return False
 
-        self.is_throttled = False
+        pending.Pop()
         status = self.CreateTask(file)
+        if not status:
+            self.lock.Refund()
         return status
 
-    def PrintCheckTasks(self):
+    def AddIndexes(self, indexes: List[int]):
+        if self.ActiveQueueFull():
+            return False
+
+        # 跳过已被其他流程处理的文件
+        while True:
+            if len(indexes) == 0:
+                self.is_throttled = False
+                return None
+            file = self.database.file.SelectIndex(indexes[0])
+            journal = self.database.journal.Get(indexes[0])
+            if journal is not None and journal.get("dl_status") is not None:
+                indexes.pop(0)
+                continue
+            if file is None or file.dl_status != database.File.DlStatus.Wait:
+                indexes.pop(0)
+                continue
+            break
+
+        if not self.TryAcquire():
+            return False
+
+        indexes.pop(0)
+        status = self.CreateTask(file)
+        if not status:
+            self.lock.Refund()
+        return status
+
+    def CheckTasks(self, statuses: Dict[str, aria2tool.RpcStructStatus]) -> Tuple[str, List[str]]:
+        # 按已获取的任务状态处理 返回进度条和需要清除的下载结果
         rm_tasks: List[Task] = []
 
         progress_bar = str()
 
+        missing = [task.gid for task in self.active_tasks if task.gid is not None and task.gid not in statuses]
+        if len(missing) != 0:
+            for gid, status in self.aria2_client.TellStatusMany(missing).items():
+                if status is not None:
+                    statuses[gid] = status
+
+        completed_gids: List[str] = []
+
         for task in self.active_tasks:
             # 获取任务状态
-            status = task.Status()
+            status = statuses.get(str(task.gid))
             if status is None:
                 raise ValueError
 
@@ -359,13 +656,19 @@ class CopymangaDLManger:
                     rate_str = f"{str(rate).zfill(2)} "
 
             # 下载完成
-            if status.status == "complete" and self.TaskCompleted(task):
+            if status.status == "complete" and self.TaskCompleted(task, status):
                 rm_tasks.append(task)
+                completed_gids.append(status.gid)
                 progress_bar += f"-- "
 
             # 下载出现错误 重试五次后放弃
-            elif status.status == "error" and self.TaskTryfix(task):
-                progress_bar += f"ER "
+            elif status.status == "error":
+                completed_gids.append(status.gid)
+                if self.TaskTryfix(task):
+                    progress_bar += f"ER "
+                else:
+                    rm_tasks.append(task)
+                    progress_bar += f"XX "
 
             # 下载中
             elif status.status == "active":
@@ -377,32 +680,48 @@ class CopymangaDLManger:
 
             continue
 
+        # 移除已完成和放弃的任务
+        for task in rm_tasks:
+            self.active_tasks.remove(task)
+
+        return progress_bar, completed_gids
+
+    def PrintCheckTasks(self):
+        # 一次请求获取所有任务状态
+        statuses, global_stat = self.aria2_client.TellAll()
+
+        count = len(self.active_tasks)
+        progress_bar, completed_gids = self.CheckTasks(statuses)
+        self.ApplyWindow(self.controller.Update(global_stat.downloadSpeed, count))
+
         # 填充进度条
-        fill = self.max_task_num - len(self.active_tasks)
+        fill = self.max_task_num - count
         progress_bar += f"-- " * fill
 
-        status = self.aria2_client.GetGlobalStat()
-        active_fmt = f"活动({status.numActive})"
-        speed_fmt = f"{int(status.downloadSpeed / 1000)} KB/s"
+        # 清除已处理的下载结果
+        if len(completed_gids) != 0:
+            self.aria2_client.RemoveDownloadResultMany(completed_gids)
+
+        active_fmt = f"活动({global_stat.numActive})"
+        speed_fmt = f"{int(global_stat.downloadSpeed / 1000)} KB/s"
 
         throttled = ""
-        if self.is_throttled and self.lock.ReleaseTime() != 0:
-            throttled = f":{self.lock.ReleaseTime():02d}s"
+        release_time = self.lock.ReleaseTime()
+        if self.is_throttled and release_time > 0:
+            throttled = f":{int(release_time) + 1:02d}s"
 
-        self.logger.info(f"[ {progress_bar}] 任务数({len(self.active_tasks)}/{self.max_task_num}) 请求数({self.lock}{throttled}) {active_fmt} {speed_fmt}")
+        self.logger.info(f"[ {progress_bar}] 任务数({count}/{self.max_task_num}) 请求数({self.lock}{throttled}) {active_fmt} {speed_fmt}")
 
-        # 移除已完成和放弃的任务
-        for task in rm_tasks:
-            self.active_tasks.remove(task)
+        return len(completed_gids)
 
-        return len(rm_tasks)
+    def DownloadMulti(self, dl_status: int, files: Optional[List[database.FileORM]] = None):
+        if files is None:
+            self.database.Flush()
+            files = self.database.file.GetAll(
+                database.FileOptional(dl_status=dl_status),
+            )
 
-    def DownloadMulti(self, dl_status: int):
-        files = self.database.file.GetAll(
-            database.FileOptional(dl_status=dl_status),
-        )
-
-        if len(files) == 0:
+        if len(files) == 0 and self.ActiveQueueZero():
             self.logger.debug(f"没有可下载的文件")
             return
 
@@ -425,7 +744,7 @@ class CopymangaDLManger:
                 continue
 
             self.PrintCheckTasks()
-            time.sleep(1)
+            self.Wait()
             continue
         return
 
@@ -447,14 +766,48 @@ class CopymangaDLManger:
                 continue
 
             self.PrintCheckTasks()
-            time.sleep(1)
+            self.Wait()
             continue
 
         self.logger.debug(f"无下一个文件")
         return
 
+    def DownloadQueue(self, file_queue: FileQueue):
+        # 先下载已有的未开始文件 再下载更新线程新记录的文件
+        self.database.Flush()
+        indexes = [file.index for file in self.database.file.All_Wait_DlStatus()]
+        self.logger.info(f"流水线下载 已有 {len(indexes)} 个文件")
+
+        while True:
+            count = len(indexes)
+            is_closed = file_queue.Drain(indexes)
+
+            # 结束读事务 读取更新线程提交的文件
+            if len(indexes) != count:
+                self.database.Commit()
+
+            if self.AddIndexes(indexes) is None and is_closed and self.ActiveQueueZero():
+                break
+
+            if (  # 有待下载文件+队列空闲+有请求数 继续增加任务
+                len(indexes) != 0  #
+                and not self.ActiveQueueFull()
+                and not self.is_throttled
+            ):
+                continue
+
+            if not self.ActiveQueueZero():
+                self.PrintCheckTasks()
+            self.Wait()
+            continue
+
+        self.logger.debug(f"流水线无下一个文件")
+        return
+
     def Download_Unfinished(self):
         self.logger.info(f"检查未完成文件")
+        if self.resume:
+            return self.DownloadMulti(database.File.DlStatus.Active, self.ResumeTasks())
         status = self.aria2_client.GetGlobalStat()
         if status.numActive != 0:
             self.logger.error("下载服务中还有正在下载的任务 禁止检查数据库未完成文件")
@@ -469,6 +822,45 @@ class CopymangaDLManger:
         self.logger.info(f"检查一般故障文件")
         return self.DownloadMulti(database.File.DlStatus.Error)
 
+    # 调度器模式 依次下载未完成/新文件/故障文件
+    STEP_STAGES = (
+        database.File.DlStatus.Active,
+        database.File.DlStatus.Wait,
+        database.File.DlStatus.Error,
+    )
+
+    def Step(self):
+        # 最多添加一个任务 无可下载文件时返回None
+        while self.step_stage < len(self.STEP_STAGES):
+            dl_status = self.STEP_STAGES[self.step_stage]
+            # 新文件添加后状态改变 每次取第一个
+            if dl_status == database.File.DlStatus.Wait:
+                status = self.AddFile(dl_status)
+            # 未完成/故障文件添加后状态不变 开始时取全部
+            else:
+                if self.step_files is None and self.resume and dl_status == database.File.DlStatus.Active:
+                    self.step_files = self.ResumeTasks()
+                elif self.step_files is None:
+                    self.database.Flush()
+                    self.step_files = self.database.file.GetAll(
+                        database.FileOptional(dl_status=dl_status),
+                    )
+                status = self.AddFiles(self.step_files)
+            if status is not None:
+                return status
+            self.step_stage += 1
+            self.step_files = None
+            continue
+        return None
+
+    def RunPipeline(self, file_queue: FileQueue):
+        self.Download_Unfinished()
+        self.DownloadQueue(file_queue)
+        self.Download_NewFile()
+        self.Download_PathProblemFile()
+        self.logger.info(f"下载完成")
+        return
+
     def Run(self, auto_exit: bool = False):
         self.thread_exit = False
 
@@ -487,18 +879,239 @@ class CopymangaDLManger:
         return
 
 
+class CopymangaDLScheduler:
+    # 多个漫画共用一个下载服务 任务数在漫画间轮流分配
+
+    def __init__(
+        self,
+        aria2_client: aria2tool.Aria2Client,
+        open_manger: Callable[[str], CopymangaDLManger],
+        notifier: Optional[aria2tool.Aria2Notifier] = None,
+        resume: bool = False,
+    ) -> None:
+        self.logger = logger.ObjLogger(self)
+        self.resume = resume
+
+        self.controller = ConcurrencyController()
+        self.max_task_num = self.controller.Window()
+        # 同时打开的漫画数据库数
+        self.max_open_num = 4
+        self.lock = globle_download_request_lock
+
+        self.aria2_client = aria2_client
+        self.aria2_window: Optional[int] = None
+        self.open_manger = open_manger
+
+        self.pending: Deque[str] = deque()
+        self.mangers: List[CopymangaDLManger] = []
+        self.cursor = 0
+        self.finished_count = 0
+
+        self.is_throttled = False
+        # 断点续传时下载服务恢复的任务 漫画打开前保持暂停
+        self.restored_gids: Set[str] = set()
+
+        self.wakeup = threading.Event()
+        self.notifier = notifier
+        self.notify_interval = 5.0
+        if self.notifier is not None:
+            self.notifier.Subscribe(self.OnNotify)
+        return
+
+    def OnNotify(self, method: str, gid: str):
+        if method in (aria2tool.Aria2Notifier.ON_COMPLETE, aria2tool.Aria2Notifier.ON_ERROR, aria2tool.Aria2Notifier.ON_STOP):
+            self.wakeup.set()
+        return
+
+    def PauseRestored(self):
+        # 所有漫画共用一个会话文件 未打开的漫画的任务不能占用下载数
+        self.aria2_client.ForcePauseAll()
+        self.restored_gids = set(self.aria2_client.TellPaths().values())
+        if len(self.restored_gids) != 0:
+            self.logger.info(f"暂停恢复的 {len(self.restored_gids)} 个任务 等待所属漫画开始下载")
+        return
+
+    def RemoveOrphans(self):
+        # 所有漫画下载结束后 仍未被找回的恢复任务不属于任何漫画
+        orphans = [gid for gid in self.aria2_client.TellPaths().values() if gid in self.restored_gids]
+        self.restored_gids.clear()
+        if len(orphans) == 0:
+            return
+        self.logger.warn(f"移除 {len(orphans)} 个未找回的恢复任务")
+        self.aria2_client.ForceRemoveMany(orphans)
+        self.aria2_client.RemoveDownloadResultMany(orphans)
+        return
+
+    def Close(self):
+        for manger in self.mangers:
+            self.CloseManger(manger)
+        self.mangers.clear()
+        if self.resume:
+            SaveSession(self.aria2_client)
+        if self.notifier is not None:
+            self.notifier.Unsubscribe(self.OnNotify)
+        return
+
+    def Add(self, pathword: str):
+        self.pending.append(pathword)
+        return
+
+    def ActiveTaskNum(self):
+        return sum(len(manger.active_tasks) for manger in self.mangers)
+
+    def ActiveQueueFull(self):
+        return self.ActiveTaskNum() >= self.max_task_num
+
+    def ActiveQueueZero(self):
+        return self.ActiveTaskNum() == 0
+
+    def OpenManger(self):
+        # 需要时再打开数据库
+        while len(self.mangers) < self.max_open_num and len(self.pending) != 0:
+            pathword = self.pending.popleft()
+            try:
+                manger = self.open_manger(pathword)
+            except Exception as e:
+                self.logger.error(f"无法打开 {pathword}: {e}")
+                continue
+            # 任务数由调度器统一限制
+            manger.controller = self.controller
+            manger.max_task_num = self.max_task_num
+            self.mangers.append(manger)
+            self.logger.info(f"开始下载 {manger.name}")
+            continue
+        return
+
+    def ApplyWindow(self, window: int):
+        if window != self.max_task_num:
+            self.logger.debug(f"任务数 {self.max_task_num} -> {window}")
+        self.max_task_num = window
+        for manger in self.mangers:
+            manger.max_task_num = window
+        if window != self.aria2_window:
+            self.aria2_client.ChangeGlobalOption({"max-concurrent-downloads": str(window)})
+            self.aria2_window = window
+        return
+
+    def CloseManger(self, manger: CopymangaDLManger):
+        manger.Close()
+        manger.database.Close()
+        return
+
+    def FillTasks(self):
+        # 轮流为每个漫画添加任务 直到任务数已满/请求受限/无可下载文件
+        idle = 0
+        while not self.ActiveQueueFull() and len(self.mangers) != 0 and idle < len(self.mangers):
+            # 所有漫画共用请求数
+            self.is_throttled = self.lock.ReleaseTime() > 0
+            if self.is_throttled:
+                break
+            self.cursor %= len(self.mangers)
+            manger = self.mangers[self.cursor]
+            status = manger.Step()
+            # 漫画下载完成 关闭数据库 打开下一个
+            if status is None and manger.ActiveQueueZero():
+                self.logger.info(f"下载完成 {manger.name}")
+                self.mangers.pop(self.cursor)
+                self.CloseManger(manger)
+                self.finished_count += 1
+                self.OpenManger()
+                idle = 0
+                continue
+            idle = 0 if status else idle + 1
+            self.cursor += 1
+            continue
+        return
+
+    def PrintCheckTasks(self):
+        # 一次请求获取所有漫画的任务状态
+        statuses, global_stat = self.aria2_client.TellAll()
+
+        count = self.ActiveTaskNum()
+        progress_bar = str()
+        completed_gids: List[str] = []
+        for manger in self.mangers:
+            bar, gids = manger.CheckTasks(statuses)
+            progress_bar += bar
+            completed_gids += gids
+            continue
+        self.ApplyWindow(self.controller.Update(global_stat.downloadSpeed, count))
+        progress_bar += f"-- " * (self.max_task_num - count)
+
+        if len(completed_gids) != 0:
+            self.aria2_client.RemoveDownloadResultMany(completed_gids)
+
+        comic_fmt = f"漫画({self.finished_count}/{self.finished_count + len(self.mangers) + len(self.pending)})"
+        active_fmt = f"活动({global_stat.numActive})"
+        speed_fmt = f"{int(global_stat.downloadSpeed / 1000)} KB/s"
+
+        throttled = ""
+        release_time = self.lock.ReleaseTime()
+        if self.is_throttled and release_time > 0:
+            throttled = f":{int(release_time) + 1:02d}s"
+
+        self.logger.info(f"[ {progress_bar}] {comic_fmt} 任务数({count}/{self.max_task_num}) 请求数({self.lock}{throttled}) {active_fmt} {speed_fmt}")
+        return len(completed_gids)
+
+    def Wait(self):
+        for manger in self.mangers:
+            manger.database.journal.Tick()
+        release_time = self.lock.ReleaseTime() if self.is_throttled else 0.0
+        if release_time > 0 and self.ActiveQueueZero():
+            self.lock.WaitReady()
+            return
+        wait = 1.0
+        if self.notifier is not None and self.notifier.isConnected():
+            wait = self.notify_interval
+        if release_time > 0:
+            wait = min(wait, release_time)
+        self.wakeup.wait(wait)
+        self.wakeup.clear()
+        return
+
+    def Run(self):
+        # 未完成文件的检查要求下载服务中没有其他任务 断点续传时由各漫画找回
+        status = self.aria2_client.GetGlobalStat()
+        if status.numActive != 0 and not self.resume:
+            self.logger.error("下载服务中还有正在下载的任务 禁止开始调度")
+            return
+
+        if self.resume:
+            self.PauseRestored()
+
+        self.logger.info(f"调度下载 {len(self.pending)} 个漫画")
+        self.OpenManger()
+
+        while len(self.mangers) != 0:
+            self.FillTasks()
+            if len(self.mangers) == 0:
+                break
+            if not self.ActiveQueueZero():
+                self.PrintCheckTasks()
+            self.Wait()
+            continue
+
+        if self.resume:
+            self.RemoveOrphans()
+        self.logger.info(f"下载完成 共 {self.finished_count} 个漫画")
+        return
+
+
 def module_test():
     from main import win32proxy, DB_ROOT, DOWNLOAD_ROOT, TEMP_ROOT
 
     server = aria2tool.Aria2Server("dl.nosync", 99)
     server.Restart()
+    notifier = aria2tool.Aria2Notifier(server.Url())
+    notifier.Start()
 
     manger = CopymangaDLManger(
-        aria2tool.Aria2Client(server.Url(), server.Token()),
+        aria2tool.Aria2Client(server.Url(), server.Token(), validate=False),
         database.ComicDatabase(DB_ROOT / Path(f"silentwitchchenmodemonvdemimi.db")),
         win32proxy().get_proxy(),
         DOWNLOAD_ROOT,
         TEMP_ROOT,
+        notifier,
     )
 
     try:
@@ -508,6 +1121,8 @@ def module_test():
         raise e
 
     finally:
+        manger.Close()
+        notifier.Stop()
         server.Stop()
 
 
@@ -0,0 +1,165 @@
+import json
+import sqlite3
+import threading
+import time
+
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import spdlogger
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = spdlogger.logger
+
+
+def JsonDumps(data) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False).encode()
+
+
+def JsonLoads(data: bytes):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+# URL 包含的路径 -> 缓存秒数 按顺序匹配 未匹配的不缓存
+ENDPOINT_TTLS: List[Tuple[str, float]] = [
+    ("/chapter2/", 30 * 24 * 3600.0),  # 章节文件列表 发布后基本不变
+    ("/search/comic", 3600.0),
+    ("/chapters?", 600.0),  # 分组章节列表
+    ("/comic2/", 600.0),  # 漫画信息 包含更新时间
+]
+
+
+class ResponseCache:
+    MODE_OFF = "off"
+    MODE_ON = "on"
+    MODE_ONLY = "only"  # 只使用缓存 忽略过期时间 不请求网络
+
+    def __init__(self, path: Path, max_bytes: int = 64 * 1024 * 1024, mode: str = MODE_ON) -> None:
+        self.logger = logger.ObjLogger(self)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.mode = mode
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path.as_posix(), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("  #
+            "url TEXT PRIMARY KEY, body BLOB NOT NULL, size INTEGER NOT NULL, "
+            "stored_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS ix_responses_accessed_at ON responses (accessed_at)")
+        return
+
+    def __str__(self) -> str:
+        count, size = self.Usage()
+        return f"<{ResponseCache.__name__} mode={self.mode} {count} 条 {size / 1000 / 1000:.2f}/{self.max_bytes / 1000 / 1000:.0f} MB 命中 {self.hits}/{self.hits + self.misses} />"
+
+    @staticmethod
+    def TTL(url: str) -> float:
+        for pattern, ttl in ENDPOINT_TTLS:
+            if pattern in url:
+                return ttl
+            continue
+        return 0.0
+
+    def Enabled(self) -> bool:
+        return self.mode != self.MODE_OFF
+
+    def CacheOnly(self) -> bool:
+        return self.mode == self.MODE_ONLY
+
+    def Get(self, url: str) -> Optional[dict]:
+        if not self.Enabled():
+            return None
+        ttl = self.TTL(url)
+        if ttl <= 0 and not self.CacheOnly():
+            return None
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT body, stored_at FROM responses WHERE url = ?", (url,)).fetchone()
+            if row is None or (not self.CacheOnly() and row[1] + ttl <= now):
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE responses SET accessed_at = ? WHERE url = ?", (now, url))
+            self.hits += 1
+        return JsonLoads(row[0])
+
+    def Put(self, url: str, value: dict):
+        if not self.Enabled() or self.TTL(url) <= 0:
+            return
+        body = JsonDumps(value)
+        if len(body) > self.max_bytes:
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (url, body, size, stored_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (url, body, len(body), now, now),
+            )
+            self._Evict()
+        return
+
+    def Delete(self, url: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM responses WHERE url = ?", (url,))
+        return
+
+    def _Evict(self):
+        # 超出容量时按最近访问时间淘汰
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        removed = 0
+        for url, size in self._conn.execute("SELECT url, size FROM responses ORDER BY accessed_at").fetchall():
+            if total <= self.max_bytes:
+                break
+            self._conn.execute("DELETE FROM responses WHERE url = ?", (url,))
+            total -= size
+            removed += 1
+            continue
+        self.logger.debug(f"淘汰缓存 {removed} 条")
+        return
+
+    def Usage(self) -> Tuple[int, int]:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+
+    def Clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+            self._conn.execute("VACUUM")
+        return
+
+    def Close(self):
+        with self._lock:
+            self._conn.close()
+        return
+
+
+globle_response_cache: Optional[ResponseCache] = None
+
+
+def module_test():
+    import tempfile
+
+    cache = ResponseCache(Path(tempfile.mkdtemp()) / Path("cache.sqlite"), 300)
+    cache.Put("https://api/api/v3/comic/a/chapter2/1", {"a": "x" * 100})
+    cache.Put("https://api/api/v3/comic/a/chapter2/2", {"a": "x" * 100})
+    cache.Get("https://api/api/v3/comic/a/chapter2/1")
+    cache.Put("https://api/api/v3/comic/a/chapter2/3", {"a": "x" * 100})
+    print(cache, cache.Get("https://api/api/v3/comic/a/chapter2/2"))
+
+
+if __name__ == "__main__":
+    module_test()
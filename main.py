@@ -1,6 +1,7 @@
 import os
 import time
 import winreg
+import threading
 import traceback
 
 from pathlib import Path
@@ -9,8 +10,10 @@ from typing import List, Tuple
 import database
 import aria2tool
 import dlmanager
+import httpcache
 import packer
-from copymanga import CopymangaObject
+import ratelimit
+from copymanga import ChapterCrawler, CopymangaObject
 
 
 DB_ROOT = Path("db.nosync")
@@ -23,6 +26,14 @@ DOWNLOAD_ROOT.mkdir(parents=True, exist_ok=True)
 TEMP_ROOT.mkdir(parents=True, exist_ok=True)
 CBZ_ROOT.mkdir(parents=True, exist_ok=True)
 
+# 部署配置 数据库连接参数
+DB_ENGINE_CONFIG = DB_ROOT / Path("database.ini")
+database.globle_engine_profile = database.EngineProfile.Load(DB_ENGINE_CONFIG)
+
+# API响应缓存
+API_CACHE_FILE = TEMP_ROOT / Path("api_cache.sqlite")
+httpcache.globle_response_cache = httpcache.ResponseCache(API_CACHE_FILE)
+
 FILE_PREFIX = "*."
 FILE_SUFFIX = "-*.*"
 
@@ -92,6 +103,8 @@ class Console:
         self.download_root = download_root
         self.database_root = database_root
         self.proxy = proxy
+        # 断点续传模式
+        self.resume = False
 
         self.exit_status = False
         self.commands_str: str = ""
@@ -101,9 +114,12 @@ class Console:
         self.commands = {
             "help": Command(True, self.Cmd_Help, [], "显示命令列表"),
             "update": Command(True, self.Cmd_Update, ["index"], "更新数据库"),
+            "refresh": Command(True, self.Cmd_Refresh, ["index"], "忽略更新记录 强制更新数据库"),
             "download": Command(True, self.Cmd_Download, ["index"], "下载文件"),
+            "update-download": Command(True, self.Cmd_UpdateDownload, ["index"], "更新数据库同时下载文件"),
             "scan": Command(True, self.Cmd_Detect, ["index"], "标记存在的文件到已下载"),
             "check": Command(True, self.Cmd_Check, ["index"], "检查本地文件"),
+            "verify": Command(True, self.Cmd_Verify, ["index"], "校验本地文件的大小和哈希"),
             "pack-info": Command(True, self.Cmd_PackComicInfo, ["index"], "显示漫画打包信息"),
             "pack-update": Command(True, self.Cmd_PackComicUpdate, ["num", "start", "index"], "更新漫画打包信息 num=打包分割章节号 start=起始章节号"),
             "pack-run": Command(True, self.Cmd_PackComicRun, ["index"], "打包漫画"),
@@ -112,6 +128,9 @@ class Console:
             "delete": Command(False, self.Cmd_DeleteDatabase, ["index"], "删除数据库"),
             "search": Command(False, self.Cmd_Search, ["keyword"], "使用关键词搜索并创建数据库"),
             "init": Command(False, self.Cmd_Init, ["pathword"], "使用路径词创建数据库"),
+            "limit": Command(False, self.Cmd_Limit, ["host", "num"], "设置每分钟请求次数 host=api.mangacopy.com/download"),
+            "resume": Command(False, self.Cmd_Resume, ["on/off"], "断点续传模式 保留缓存和未完成的下载任务"),
+            "cache": Command(False, self.Cmd_Cache, ["on/off/only/clear"], "API响应缓存 only=只使用缓存不请求网络"),
             "list": Command(False, self.ShowComic, [], "显示漫画列表"),
             "clear": Command(False, self.Cmd_Clear, [], "清除控制台历史输出"),
             "exit": Command(False, self.Cmd_Exit, [], "退出 或 双击Ctrl+C"),
@@ -190,15 +209,18 @@ class Console:
 
         return index
 
-    def _CopymangaIndex(self, i: int):
-        return self._CopymangaPathword(self.comics[i][0])
+    def _CopymangaIndex(self, i: int, offline: bool = False):
+        return self._CopymangaPathword(self.comics[i][0], offline)
 
-    def _CopymangaPathword(self, pathword: str):
+    def _CopymangaPathword(self, pathword: str, offline: bool = False, fresh: bool = False):
+        # offline 只读取本地数据库 需要时再请求漫画信息 fresh 不读取漫画信息和章节列表的API响应缓存
         return CopymangaObject(
             download_root=self.download_root,
             database_root=self.database_root,
             pathword=pathword,
             proxy=self.proxy,
+            offline=offline,
+            fresh=fresh,
         )
 
     def _CopymangaKeyword(self, keyword: str):
@@ -226,39 +248,148 @@ class Console:
     def Cmd_Help(self, argv: List[str]):
         self.ShowCommand(argv)
 
-    def Cmd_Update(self, argv: List[str]):
+    def _UpdateComics(self, argv: List[str], force: bool):
+        # 所有漫画的章节文件请求共用一个线程池 在当前线程写入数据库
+        crawler = ChapterCrawler()
+
         def Update(pathword: str):
-            comic = self._CopymangaPathword(pathword)
-            comic.ShowMetadate()
-            comic.UpdateAll(not_files=False)
+            # 单个漫画获取信息或章节列表失败时跳过 继续其他漫画
+            try:
+                comic = self._CopymangaPathword(pathword, fresh=True)
+                comic.ShowMetadate()
+                crawler.Add(comic, force)
+            except Exception as e:
+                traceback.print_exc()
+                print(f"更新 {pathword} 时发生错误: {e}")
             return
 
-        return self.Cmd_All(argv, Update)
+        try:
+            self.Cmd_All(argv, Update)
+        except KeyboardInterrupt:
+            # 中断时取消已提交的章节请求 不再获取
+            crawler.Cancel()
+            raise
+        crawler.Run()
+        return
+
+    def Cmd_Update(self, argv: List[str]):
+        return self._UpdateComics(argv, force=False)
+
+    def Cmd_Refresh(self, argv: List[str]):
+        return self._UpdateComics(argv, force=True)
 
     def Cmd_Download(self, argv: List[str]):
+        if argv[1] == "all":
+            return self.DownloadAll()
+
         def Download(pathword: str):
-            server = aria2tool.Aria2Server("dl.nosync", 99)
+            server = aria2tool.Aria2Server("dl.nosync", 99, session_file=self.SessionFile(pathword))
             server.Restart()
+            notifier = aria2tool.Aria2Notifier(server.Url())
+            notifier.Start()
             manger = dlmanager.CopymangaDLManger(
-                aria2tool.Aria2Client(server.Url(), server.Token()),
+                aria2tool.Aria2Client(server.Url(), server.Token(), validate=False),
                 database.ComicDatabase(self.database_root / Path(f"{pathword}.db")),
                 self.proxy,
                 self.download_root,
                 self.temp_root,
+                notifier,
+                self.resume,
             )
             try:
                 manger.Run(auto_exit=True)
             except Exception as e:
                 print(f"下载时发送错误: {e}")
             finally:
+                manger.Close()
+                notifier.Stop()
                 server.Stop()
             return
 
         return self.Cmd_All(argv, Download)
 
+    def SessionFile(self, name: str):
+        # 断点续传时 下载服务的会话文件
+        if not self.resume:
+            return None
+        return self.temp_root / Path(f"{name}.session")
+
+    def DownloadAll(self):
+        # 所有漫画共用一个下载服务
+        server = aria2tool.Aria2Server("dl.nosync", 99, session_file=self.SessionFile("download-all"))
+        server.Restart()
+        notifier = aria2tool.Aria2Notifier(server.Url())
+        notifier.Start()
+        client = aria2tool.Aria2Client(server.Url(), server.Token(), validate=False)
+
+        def OpenManger(pathword: str):
+            return dlmanager.CopymangaDLManger(
+                client,
+                database.ComicDatabase(self.database_root / Path(f"{pathword}.db")),
+                self.proxy,
+                self.download_root,
+                self.temp_root,
+                resume=self.resume,
+            )
+
+        scheduler = dlmanager.CopymangaDLScheduler(client, OpenManger, notifier, self.resume)
+        for pathword, _ in self.comics:
+            scheduler.Add(pathword)
+        try:
+            scheduler.Run()
+        except Exception as e:
+            print(f"下载时发送错误: {e}")
+        finally:
+            scheduler.Close()
+            notifier.Stop()
+            server.Stop()
+        return
+
+    def Cmd_UpdateDownload(self, argv: List[str]):
+        def UpdateDownload(pathword: str):
+            comic = self._CopymangaPathword(pathword, fresh=True)
+            comic.ShowMetadate()
+            server = aria2tool.Aria2Server("dl.nosync", 99, session_file=self.SessionFile(pathword))
+            server.Restart()
+            notifier = aria2tool.Aria2Notifier(server.Url())
+            notifier.Start()
+            manger = dlmanager.CopymangaDLManger(
+                aria2tool.Aria2Client(server.Url(), server.Token(), validate=False),
+                database.ComicDatabase(self.database_root / Path(f"{pathword}.db")),
+                self.proxy,
+                self.download_root,
+                self.temp_root,
+                notifier,
+                self.resume,
+            )
+            file_queue = dlmanager.FileQueue(manger.wakeup)
+            comic.on_file_added = file_queue.Put
+
+            def Download():
+                try:
+                    manger.RunPipeline(file_queue)
+                except Exception as e:
+                    traceback.print_exc()
+                    print(f"下载时发送错误: {e}")
+
+            thread = threading.Thread(target=Download)
+            thread.start()
+            try:
+                comic.UpdateAll(not_files=False)
+            finally:
+                comic.on_file_added = None
+                file_queue.Close()
+                thread.join()
+                manger.Close()
+                notifier.Stop()
+                server.Stop()
+            return
+
+        return self.Cmd_All(argv, UpdateDownload)
+
     def Cmd_Detect(self, argv: List[str]):
         def Detect(pathword: str):
-            comic = self._CopymangaPathword(pathword)
+            comic = self._CopymangaPathword(pathword, offline=True)
             comic.ShowMetadate()
             comic.DetectFiles()
             return
@@ -267,13 +398,22 @@ class Console:
 
     def Cmd_Check(self, argv: List[str]):
         def Check(pathword: str):
-            comic = self._CopymangaPathword(pathword)
+            comic = self._CopymangaPathword(pathword, offline=True)
             comic.ShowMetadate()
             comic.CheckFiles()
             return
 
         return self.Cmd_All(argv, Check)
 
+    def Cmd_Verify(self, argv: List[str]):
+        def Verify(pathword: str):
+            comic = self._CopymangaPathword(pathword, offline=True)
+            comic.ShowMetadate()
+            comic.VerifyFiles()
+            return
+
+        return self.Cmd_All(argv, Verify)
+
     def Cmd_PackComicInfo(self, argv: List[str]):
         def Show(pathword: str):
             packer.FilePacker(
@@ -321,7 +461,7 @@ class Console:
         num = self.ConvertIndex(argv[0], argv[1])
         if num is None:
             return
-        comic = self._CopymangaIndex(num)
+        comic = self._CopymangaIndex(num, offline=True)
         comic.ShowMetadate()
         comic.CheckFiles(mark_removed_file=True)
         return
@@ -330,7 +470,7 @@ class Console:
         num = self.ConvertIndex(argv[0], argv[1])
         if num is None:
             return
-        comic = self._CopymangaIndex(num)
+        comic = self._CopymangaIndex(num, offline=True)
         comic.ShowMetadate()
         comic.UpdateAll(not_files=True)
         return
@@ -339,13 +479,15 @@ class Console:
         num = self.ConvertIndex(argv[0], argv[1])
         if num is None:
             return
-        comic = self._CopymangaIndex(num)
+        comic = self._CopymangaIndex(num, offline=True)
         check_delete = input(f"删除 {comic.database} 数据库文件 输入[Yes]确认操作(区分大小写)=")
         if check_delete == "Yes":
-            db = comic.database.GetDatabaseFilePath()
-            print(f'保留本地目录 "{(self.download_root / Path(comic.comic.name)).as_posix()}"')
+            db_files = comic.database.GetDatabaseFiles()
+            print(f'保留本地目录 "{comic.download_folder.as_posix()}"')
+            comic.database.Close()
             del comic
-            db.unlink()
+            for db in db_files:
+                db.unlink(missing_ok=True)
         else:
             print(f"取消删除数据库")
         return
@@ -371,6 +513,53 @@ class Console:
         print(f"增加 {comic.comic.name} / {comic.comic.path_word}")
         return
 
+    def Cmd_Limit(self, argv: List[str]):
+        cmd = argv[0]
+        host = argv[1]
+        try:
+            num = int(argv[2], 10)
+        except Exception:
+            print(f" {cmd} 参数 num={argv[2]} 不是十进制数字.")
+            return
+        if num <= 0:
+            print(f" {cmd} 参数 num={num} 必须大于0.")
+            return
+        hosts = ratelimit.globle_rate_limiters.Hosts()
+        if host not in hosts:
+            print(f" {cmd} 参数 host={host} 不存在 可用: {' '.join(hosts.keys())}")
+            return
+        ratelimit.globle_rate_limiters.SetLimit(host, num)
+        for name, limiter in hosts.items():
+            print(f" {name} {limiter} 每 {limiter.GetLimit()[1]:.0f} 秒")
+        return
+
+    def Cmd_Resume(self, argv: List[str]):
+        cmd = argv[0]
+        value = argv[1]
+        if value not in ("on", "off"):
+            print(f" {cmd} 参数 {value} 不是 on/off.")
+            return
+        self.resume = value == "on"
+        print(f" 断点续传模式 {'开启' if self.resume else '关闭'}")
+        return
+
+    def Cmd_Cache(self, argv: List[str]):
+        cmd = argv[0]
+        value = argv[1]
+        cache = httpcache.globle_response_cache
+        if cache is None:
+            print(f" 没有启用API响应缓存")
+            return
+        if value == "clear":
+            cache.Clear()
+        elif value in (cache.MODE_ON, cache.MODE_OFF, cache.MODE_ONLY):
+            cache.mode = value
+        else:
+            print(f" {cmd} 参数 {value} 不是 on/off/only/clear.")
+            return
+        print(f" {cache}")
+        return
+
     def Cmd_Clear(self, argv: List[str]):
         os.system("cls")
 
@@ -1,17 +1,24 @@
 import datetime
+import fnmatch
+import glob
 import os
+import shutil
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from pathlib import Path
 from pprint import pprint
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple
 from copymanga import CopymangaObject
 from database import ComicDatabase
 import database
 from main import CBZ_ROOT, DB_ROOT, DOWNLOAD_ROOT, FILE_PREFIX, FILE_SUFFIX
 from spdlogger import logger
+import scanner
 import subprocess
 from configparser import ConfigParser
 import unicodedata
 import zipfile
+import zlib
 
 
 def isInvalidPath(s: str):
@@ -98,6 +105,55 @@ class StringView:
         return s
 
 
+CBZ_CODECS = {
+    "stored": zipfile.ZIP_STORED,
+    "deflate": zipfile.ZIP_DEFLATED,
+}
+CBZ_CODEC_AUTO = "auto"
+CBZ_AUTO_SAMPLE_FILES = 4
+CBZ_AUTO_SAMPLE_SIZE = 256 * 1024
+CBZ_AUTO_MIN_SAVING = 0.05  # 采样压缩节省不足 5% 时使用 stored
+CBZ_COPY_BUFSIZE = 1024 * 1024
+
+
+def ChooseCbzCodec(files: List[Path], codec: str) -> str:
+    if codec != CBZ_CODEC_AUTO:
+        return codec
+    # 采样前几页 webp/jpg 通常已压缩 deflate 几乎没有收益
+    raw_size = 0
+    zip_size = 0
+    for file in files[:CBZ_AUTO_SAMPLE_FILES]:
+        with open(file, "rb") as f:
+            data = f.read(CBZ_AUTO_SAMPLE_SIZE)
+        raw_size += len(data)
+        zip_size += len(zlib.compress(data, zlib.Z_DEFAULT_COMPRESSION))
+        continue
+    if raw_size == 0 or zip_size >= raw_size * (1 - CBZ_AUTO_MIN_SAVING):
+        return "stored"
+    return "deflate"
+
+
+def CreateCbz(path: Path, files: List[Path], codec: str = "deflate") -> Tuple[int, int, float, str]:
+    # 写入一个CBZ 返回 (CBZ大小, 原文件大小, 耗时, 编码)
+    # zlib 压缩时释放 GIL 可以在线程池中并行
+    start = time.perf_counter()
+    codec = ChooseCbzCodec(files, codec)
+    compression = CBZ_CODECS[codec]
+    file_size = 0
+    with zipfile.ZipFile(path.as_posix(), "w", compression) as z:
+        for file in files:
+            # 分块复制 不把整个文件读入内存
+            src = file.resolve()
+            info = zipfile.ZipInfo.from_file(src.as_posix(), file.name)
+            info.compress_type = compression
+            file_size += info.file_size
+            with open(src, "rb") as fsrc, z.open(info, "w") as fdst:
+                shutil.copyfileobj(fsrc, fdst, CBZ_COPY_BUFSIZE)
+            continue
+        pass
+    return path.stat().st_size, file_size, time.perf_counter() - start, codec
+
+
 class PackageChapter:
     def __init__(self, group: str, name: str) -> None:
         self.group = group
@@ -138,8 +194,12 @@ class PackageChapter:
     def GetGlob(self, prefix: str, suffix: str):
         return f"{self.group}/{prefix}{self.name}{suffix}"
 
-    def GetFiles(self, comic_root: Path, prefix: str, suffix: str):
-        return list(comic_root.glob(self.GetGlob(prefix, suffix)))
+    def GetFiles(self, comic_root: Path, prefix: str, suffix: str, dir_index: Optional[scanner.ComicDirIndex] = None):
+        if dir_index is None:
+            return list(comic_root.glob(self.GetGlob(prefix, suffix)))
+        # 从目录索引匹配 章节名中的 [ ] * ? 按原样比较
+        names = fnmatch.filter(dir_index.Files(self.group), f"{prefix}{glob.escape(self.name)}{suffix}")
+        return [comic_root / self.group / name for name in sorted(names)]
 
     def GetIdentifier(self):
         if self.group is None:
@@ -176,8 +236,18 @@ class ComicPackage:
     ST_FIND_VALUE_NO_SPACE = 2
     ST_FIND_VALUE_WITH_SPACE = 3
 
-    def __init__(self, comic_dir: Path, output_dir: Path, comic_name: str, cbz_name: str, glob_prefix: str, glob_suffix: str) -> None:
+    def __init__(
+        self,
+        comic_dir: Path,
+        output_dir: Path,
+        comic_name: str,
+        cbz_name: str,
+        glob_prefix: str,
+        glob_suffix: str,
+        dir_index: Optional[scanner.ComicDirIndex] = None,
+    ) -> None:
         self.comic_dir: Path = comic_dir
+        self.dir_index = dir_index
         self.output_dir = output_dir
         self.skip_output = False
         self.comic_name: str = comic_name
@@ -187,8 +257,17 @@ class ComicPackage:
         self.groups: Dict[str, Dict[str, PackageChapter]] = {}
 
     @staticmethod
-    def FromParse(comic_dir: Path, output_dir: Path, comic_name: str, cbz_name: str, parse_text: str, glob_prefix: str, glob_suffix: str):
-        cbz = ComicPackage(comic_dir, output_dir, comic_name, cbz_name, glob_prefix, glob_suffix)
+    def FromParse(
+        comic_dir: Path,
+        output_dir: Path,
+        comic_name: str,
+        cbz_name: str,
+        parse_text: str,
+        glob_prefix: str,
+        glob_suffix: str,
+        dir_index: Optional[scanner.ComicDirIndex] = None,
+    ):
+        cbz = ComicPackage(comic_dir, output_dir, comic_name, cbz_name, glob_prefix, glob_suffix, dir_index)
 
         cbz.ParseConfig(f" {parse_text} ")
         return cbz
@@ -197,7 +276,7 @@ class ComicPackage:
         chapters_str: str = " "
         for group in self.groups.values():
             for chapter in group.values():
-                file_count = len(chapter.GetFiles(self.comic_dir, self.glob_prefix, self.glob_suffix))
+                file_count = len(chapter.GetFiles(self.comic_dir, self.glob_prefix, self.glob_suffix, self.dir_index))
                 chapters_str += f"{chapter.GetIdentifier()}:{file_count} "
                 continue
             continue
@@ -213,7 +292,7 @@ class ComicPackage:
         files: List[Path] = []
         for group in self.groups.values():
             for chapter in group.values():
-                files += chapter.GetFiles(self.comic_dir, self.glob_prefix, self.glob_suffix)
+                files += chapter.GetFiles(self.comic_dir, self.glob_prefix, self.glob_suffix, self.dir_index)
                 continue
             continue
         return files
@@ -222,7 +301,7 @@ class ComicPackage:
         files: List[List[Path]] = []
         for group in self.groups.values():
             for chapter in group.values():
-                files.append(chapter.GetFiles(self.comic_dir, self.glob_prefix, self.glob_suffix))
+                files.append(chapter.GetFiles(self.comic_dir, self.glob_prefix, self.glob_suffix, self.dir_index))
                 continue
             continue
         return files
@@ -467,6 +546,8 @@ class FilePacker:
     _INI_CONFIG_CBZ_PREFIX = "CBZ_PREFIX"
     _INI_CONFIG_GLOB_PREFIX = ["GLOB_PREFIX", FILE_PREFIX]
     _INI_CONFIG_GLOB_SUFFIX = ["GLOB_SUFFIX", FILE_SUFFIX]
+    _INI_CONFIG_CBZ_WORKERS = ["CBZ_WORKERS", "0"]  # 并行打包数 0=CPU核心数
+    _INI_CONFIG_CBZ_CODEC = ["CBZ_CODEC", CBZ_CODEC_AUTO]  # auto/stored/deflate
     _INI_CBZ_FILES = "Cbz"
     _INI_CBZ_EXAMPLE = {
         # "语法示例CBZ定义格式1": "CBZ文件名 = [ 第0话 第1话 第2话 ]              // 开头[后一个字符，结尾]前一个字符，是必须是空格",
@@ -505,9 +586,14 @@ class FilePacker:
 
         self.output_dir.mkdir(parents=True, exist_ok=True)
 
+        # 每次运行扫描一次漫画目录 所有章节从索引中匹配文件
+        self.dir_index = scanner.ComicDirIndex(self.comic_dir).Scan()
+
         self.glob_prefix = FILE_PREFIX
         self.glob_suffix = FILE_SUFFIX
         self.cbz_prefix = str()
+        self.cbz_workers = 0
+        self.cbz_codec = CBZ_CODEC_AUTO
 
         self.conf_file = self.database_root / Path(f"{pathword}.ini")
         self.conf = self._LoadConfig()
@@ -533,6 +619,7 @@ class FilePacker:
                 conf.get(self._INI_CBZ_FILES, cbz_name),
                 self.glob_prefix,
                 self.glob_suffix,
+                self.dir_index,
             )
 
             self.cbz_tasks.append(cbz)
@@ -567,15 +654,31 @@ class FilePacker:
             conf.set(self._INI_CONFIG, self._INI_CONFIG_CBZ_PREFIX, self.comic_dir.name)
             conf.set(self._INI_CONFIG, self._INI_CONFIG_GLOB_PREFIX[0], self._INI_CONFIG_GLOB_PREFIX[1])
             conf.set(self._INI_CONFIG, self._INI_CONFIG_GLOB_SUFFIX[0], self._INI_CONFIG_GLOB_SUFFIX[1])
+            conf.set(self._INI_CONFIG, self._INI_CONFIG_CBZ_WORKERS[0], self._INI_CONFIG_CBZ_WORKERS[1])
+            conf.set(self._INI_CONFIG, self._INI_CONFIG_CBZ_CODEC[0], self._INI_CONFIG_CBZ_CODEC[1])
             for key in self._INI_CBZ_EXAMPLE.keys():
                 conf.set(self._INI_CONFIG, key, self._INI_CBZ_EXAMPLE[key])
             conf.add_section(self._INI_CBZ_FILES)
         else:
             conf.read(self.conf_file.as_posix(), encoding="utf-8")
+            for key, value in [self._INI_CONFIG_CBZ_WORKERS, self._INI_CONFIG_CBZ_CODEC]:
+                if not conf.has_option(self._INI_CONFIG, key):
+                    conf.set(self._INI_CONFIG, key, value)
+                continue
 
         self.glob_prefix = conf.get(self._INI_CONFIG, self._INI_CONFIG_GLOB_PREFIX[0])
         self.glob_suffix = conf.get(self._INI_CONFIG, self._INI_CONFIG_GLOB_SUFFIX[0])
         self.cbz_prefix = conf.get(self._INI_CONFIG, self._INI_CONFIG_CBZ_PREFIX)
+        try:
+            self.cbz_workers = conf.getint(self._INI_CONFIG, self._INI_CONFIG_CBZ_WORKERS[0])
+        except ValueError:
+            workers = conf.get(self._INI_CONFIG, self._INI_CONFIG_CBZ_WORKERS[0])
+            self.logger.warn(f"无效并行打包数 {workers} 使用 {self._INI_CONFIG_CBZ_WORKERS[1]}")
+            self.cbz_workers = int(self._INI_CONFIG_CBZ_WORKERS[1])
+        self.cbz_codec = conf.get(self._INI_CONFIG, self._INI_CONFIG_CBZ_CODEC[0]).strip().lower()
+        if self.cbz_codec != CBZ_CODEC_AUTO and self.cbz_codec not in CBZ_CODECS:
+            self.logger.warn(f"未知打包编码 {self.cbz_codec} 使用 {CBZ_CODEC_AUTO}")
+            self.cbz_codec = CBZ_CODEC_AUTO
         self._LoadCbzSection(conf)
 
         return conf
@@ -668,7 +771,7 @@ class FilePacker:
                 continue
 
             chapter = PackageChapter.FromIdentifier(f"{orm_chapter.group}/{orm_chapter.name}")
-            count = len(chapter.GetFiles(self.comic_dir, self.glob_prefix, self.glob_suffix))
+            count = len(chapter.GetFiles(self.comic_dir, self.glob_prefix, self.glob_suffix, self.dir_index))
 
             if count == 0:
                 self.logger.warn(f"章节 {chapter.GetIdentifier()} 本地没有文件 将被忽略")
@@ -764,6 +867,7 @@ class FilePacker:
                     "null",
                     self.glob_prefix,
                     self.glob_suffix,
+                    self.dir_index,
                 )
                 groups = cbz.groups
                 self.logger.info(f"新建 {cbz}")
@@ -862,6 +966,7 @@ class FilePacker:
                     "null",
                     self.glob_prefix,
                     self.glob_suffix,
+                    self.dir_index,
                 )
                 groups = cbz.groups
                 self.logger.info(f"新建 {cbz}")
@@ -906,18 +1011,11 @@ class FilePacker:
 
         return
 
-    def _CreateCbz(self, path: Path, files: List[Path]):
-        with zipfile.ZipFile(path.as_posix(), "w", zipfile.ZIP_DEFLATED) as z:
-            for file in files:
-                z.write(file.resolve().as_posix(), file.name)
-                continue
-            pass
-        return
-
-    def OutputAllPackage(self):
+    def OutputAllPackage(self, workers: Optional[int] = None):
         self.logger.debug(f"导出Cbz文件")
         self.conf = self._LoadConfig()
         result: List[ComicPackage] = []
+        jobs: List[Tuple[ComicPackage, Path, List[Path]]] = []
         for cbz in self.cbz_tasks:
             cbz_path = self.output_dir.as_posix() / cbz.GetFileName()
             cbzinfo = self.conf.get(self._INI_CBZ_FILES, cbz.cbz_name)
@@ -935,23 +1033,48 @@ class FilePacker:
             files: List[Path] = []
             for group in cbz.groups.values():
                 for chapter in group.values():
-                    chapter_files = chapter.GetFiles(self.comic_dir, self.glob_prefix, self.glob_suffix)
+                    chapter_files = chapter.GetFiles(self.comic_dir, self.glob_prefix, self.glob_suffix, self.dir_index)
                     self.logger.info(f"| + 文件数:{len(chapter_files)} {chapter.GetIdentifier()} ")
                     files += chapter_files
                     continue
                 continue
-            self._CreateCbz(cbz_path, files)
-            cbz_size = cbz_path.stat().st_size
-            file_size = 0.0
-            for file in files:
-                file_size += file.stat().st_size
-            cbzinfo = "# " + cbzinfo
-            self.conf.set(self._INI_CBZ_FILES, cbz.cbz_name, cbzinfo)
-            self.logger.info(f'| > 更新配置 " {cbzinfo} "')
-            self.logger.info(f"| = 打包完成 {cbz_size / 1000 / 1000:.2f} MB 压缩率 {(file_size / cbz_size) * 100:.2f}%")
-            self.SaveConfig()
-            result.append(cbz)
+            jobs.append((cbz, cbz_path, files))
             continue
+
+        if workers is None:
+            workers = self.cbz_workers
+        if workers <= 0:
+            workers = os.cpu_count() or 1
+        workers = max(1, min(workers, len(jobs)))
+        if len(jobs) > 0:
+            self.logger.info(f"| 并行打包 {len(jobs)} 个文件 线程数 {workers}")
+
+        # 压缩在线程池中进行 配置的更新和保存只在当前线程
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures: Dict[Future, Tuple[ComicPackage, Path, List[Path]]] = {}
+            for job in jobs:
+                futures[executor.submit(CreateCbz, job[1], job[2], self.cbz_codec)] = job
+            for future in as_completed(futures):
+                cbz, cbz_path, files = futures[future]
+                try:
+                    cbz_size, file_size, elapsed, codec = future.result()
+                except Exception as e:
+                    self.logger.error(f"| 打包失败 {cbz.GetFileName()} {e}")
+                    cbz_path.unlink(missing_ok=True)
+                    continue
+                cbzinfo = self.conf.get(self._INI_CBZ_FILES, cbz.cbz_name)
+                cbzinfo = "# " + cbzinfo
+                self.conf.set(self._INI_CBZ_FILES, cbz.cbz_name, cbzinfo)
+                self.logger.info(f'| > 更新配置 " {cbzinfo} "')
+                self.logger.info(
+                    f"| = 打包完成 {cbz.GetFileName()} {codec} {cbz_size / 1000 / 1000:.2f} MB"
+                    f" 压缩率 {(file_size / max(cbz_size, 1)) * 100:.2f}%"
+                    f" {file_size / 1000 / 1000 / max(elapsed, 1e-6):.2f} MB/s"
+                )
+                self.SaveConfig()
+                result.append(cbz)
+                continue
+
         if len(result) == 0:
             self.logger.info(f"无文件更改")
             return
@@ -0,0 +1,147 @@
+import time
+import asyncio
+import threading
+
+from collections import deque
+from typing import Deque, Dict, Optional
+
+
+class RateLimiter:
+    def __init__(self, num: int, period: float = 61.0) -> None:
+        # 滑动窗口 任意 period 秒内最多 num 次请求
+        self._stamps: Deque[float] = deque()
+        self._cond = threading.Condition()
+        self._num = num
+        self._period = period
+
+    def __str__(self) -> str:
+        with self._cond:
+            self._Refresh(time.monotonic())
+            return f"{len(self._stamps)}/{self._num}"
+
+    def _Refresh(self, now: float):
+        while len(self._stamps) != 0 and self._stamps[0] + self._period <= now:
+            self._stamps.popleft()
+        return
+
+    def _ReleaseTime(self, now: float) -> float:
+        self._Refresh(now)
+        if len(self._stamps) < self._num:
+            return 0.0
+        return self._stamps[len(self._stamps) - self._num] + self._period - now
+
+    def SetLimit(self, num: int, period: Optional[float] = None):
+        with self._cond:
+            self._num = num
+            if period is not None:
+                self._period = period
+            self._cond.notify_all()
+        return
+
+    def GetLimit(self):
+        return self._num, self._period
+
+    def ReleaseTime(self) -> float:
+        # 距离下一个可用请求的秒数
+        with self._cond:
+            return self._ReleaseTime(time.monotonic())
+
+    def Remaining(self) -> int:
+        with self._cond:
+            self._Refresh(time.monotonic())
+            return max(0, self._num - len(self._stamps))
+
+    def Reset(self):
+        with self._cond:
+            self._stamps.clear()
+            self._cond.notify_all()
+        return
+
+    def Add(self):
+        # 不检查限制 直接计数
+        with self._cond:
+            self._stamps.append(time.monotonic())
+        return
+
+    def Refund(self):
+        # 退还最近一次计数
+        with self._cond:
+            if len(self._stamps) != 0:
+                self._stamps.pop()
+            self._cond.notify_all()
+        return
+
+    def TryAcquire(self) -> bool:
+        with self._cond:
+            now = time.monotonic()
+            if self._ReleaseTime(now) > 0:
+                return False
+            self._stamps.append(now)
+            return True
+
+    def WaitReady(self, timeout: Optional[float] = None) -> bool:
+        # 等待到有可用请求 不计数
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                wait = self._ReleaseTime(now)
+                if wait <= 0:
+                    return True
+                if deadline is not None:
+                    if now >= deadline:
+                        return False
+                    wait = min(wait, deadline - now)
+                self._cond.wait(wait)
+
+    def Acquire(self):
+        # 阻塞 直到下一个可用请求
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                wait = self._ReleaseTime(now)
+                if wait <= 0:
+                    self._stamps.append(now)
+                    return
+                self._cond.wait(wait)
+
+    async def AcquireAsync(self):
+        while not self.TryAcquire():
+            await asyncio.sleep(self.ReleaseTime())
+        return
+
+
+class RateLimiterRegistry:
+    def __init__(self) -> None:
+        self._limiters: Dict[str, RateLimiter] = {}
+        self._lock = threading.Lock()
+
+    def __str__(self) -> str:
+        with self._lock:
+            return ", ".join(f"{host}={limiter}" for host, limiter in self._limiters.items())
+
+    def Get(self, host: str, num: int, period: float = 61.0) -> RateLimiter:
+        # 已存在时返回原有实例 num/period 仅在创建时使用
+        with self._lock:
+            limiter = self._limiters.get(host)
+            if limiter is None:
+                limiter = RateLimiter(num, period)
+                self._limiters[host] = limiter
+            return limiter
+
+    def SetLimit(self, host: str, num: int, period: Optional[float] = None) -> RateLimiter:
+        with self._lock:
+            limiter = self._limiters.get(host)
+            if limiter is None:
+                limiter = RateLimiter(num, 61.0 if period is None else period)
+                self._limiters[host] = limiter
+                return limiter
+        limiter.SetLimit(num, period)
+        return limiter
+
+    def Hosts(self):
+        with self._lock:
+            return dict(self._limiters)
+
+
+globle_rate_limiters = RateLimiterRegistry()
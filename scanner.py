@@ -0,0 +1,153 @@
+import os
+import hashlib
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import spdlogger
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+logger = spdlogger.logger
+
+
+def _NewHash(algorithm: str):
+    if algorithm == "xxh3" and xxhash is not None:
+        return xxhash.xxh3_128()
+    if algorithm == "b2":
+        return hashlib.blake2b(digest_size=16)
+    return None
+
+
+def FileDigest(path: Path, like: str = "") -> str:
+    # 结果带算法前缀 "xxh3:..." / "b2:..." 有记录时使用相同算法
+    algorithm = like.partition(":")[0]
+    h = _NewHash(algorithm)
+    if h is None:
+        algorithm = "xxh3" if xxhash is not None else "b2"
+        h = _NewHash(algorithm)
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(1 << 20)
+            if len(chunk) == 0:
+                break
+            h.update(chunk)
+    return f"{algorithm}:{h.hexdigest()}"
+
+
+def SameAlgorithm(a: str, b: str) -> bool:
+    return a.partition(":")[0] == b.partition(":")[0]
+
+
+def FileManifest(path: Path, like: str = "") -> Tuple[int, int, str]:
+    # 大小 修改时间(ns) 哈希
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns, FileDigest(path, like)
+
+
+def ImageIntact(path: Path) -> bool:
+    # 按文件头识别图片格式 检查文件尾是否完整 未识别的格式不检查
+    size = os.stat(path).st_size
+    with open(path, "rb") as f:
+        head = f.read(12)
+        f.seek(max(0, size - 64))
+        tail = f.read()
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return size >= int.from_bytes(head[4:8], "little") + 8
+    if head[:3] == b"\xff\xd8\xff":
+        return tail.rstrip(b"\x00").endswith(b"\xff\xd9")
+    if head[:8] == b"\x89PNG\r\n\x1a\n":
+        return tail[-8:-4] == b"IEND"
+    return True
+
+
+def _ScanDir(path: str) -> Tuple[Dict[str, str], List[str]]:
+    # 一个目录的文件名和子目录 文件名 normcase -> 原文件名
+    names: Dict[str, str] = {}
+    dirs: List[str] = []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(entry.name)
+                elif entry.is_file():
+                    names[os.path.normcase(entry.name)] = entry.name
+    except FileNotFoundError:
+        pass
+    return names, dirs
+
+
+class ComicDirIndex:
+    # 漫画下载目录的文件名索引 每个目录一次 os.scandir 目录间并行
+    def __init__(self, root: Path, workers: int = 8) -> None:
+        self.logger = logger.ObjLogger(self)
+        self.root = root
+        self.workers = workers
+        self._dirs: Dict[str, Dict[str, str]] = {}
+
+    def __len__(self) -> int:
+        return sum(len(names) for names in self._dirs.values())
+
+    def Scan(self):
+        self._dirs.clear()
+        if not self.root.is_dir():
+            return self
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {"": executor.submit(_ScanDir, self.root.as_posix())}
+            while len(futures) != 0:
+                reldir, future = futures.popitem()
+                names, dirs = future.result()
+                self._dirs[os.path.normcase(reldir)] = names
+                for name in dirs:
+                    sub = name if len(reldir) == 0 else f"{reldir}/{name}"
+                    futures[sub] = executor.submit(_ScanDir, (self.root / Path(sub)).as_posix())
+                continue
+        self.logger.debug(f'索引 {len(self._dirs)} 个目录 {len(self)} 个文件 "{self.root.as_posix()}"')
+        return self
+
+    def Names(self, reldir: str) -> Dict[str, str]:
+        return self._dirs.get(os.path.normcase(reldir), {})
+
+    def Files(self, reldir: str) -> List[str]:
+        # 原文件名
+        return list(self.Names(reldir).values())
+
+    def Exists(self, relpath: str) -> bool:
+        # relpath 为相对漫画目录的路径 "group/0001.chapter-001.webp"
+        reldir, _, name = relpath.rpartition("/")
+        return os.path.normcase(name) in self.Names(reldir)
+
+    def Chapters(self, reldir: str) -> Dict[int, List[str]]:
+        # 按文件名的章节序号分组 "0001.chapter-001.webp" -> {1: ["chapter-001.webp"]}
+        chapters: Dict[int, List[str]] = {}
+        for name in self.Names(reldir):
+            head, _, rest = name.partition(".")
+            if not head.isdigit():
+                continue
+            chapters.setdefault(int(head, 10), []).append(rest)
+        return chapters
+
+
+def CountChapterPages(chapters: Dict[int, List[str]], index: int, name: str) -> int:
+    # 按前缀匹配 "{name}-*.*" 章节名中的 [ ] * 等字符按原样比较
+    prefix = os.path.normcase(f"{name}-")
+    count = 0
+    for rest in chapters.get(index, []):
+        if rest.startswith(prefix) and "." in rest[len(prefix) :]:
+            count += 1
+    return count
+
+
+def module_test():
+    import sys
+
+    index = ComicDirIndex(Path(sys.argv[1] if len(sys.argv) > 1 else ".")).Scan()
+    print(f"{len(index)} files")
+
+
+if __name__ == "__main__":
+    module_test()